@@ -1,18 +1,93 @@
 import os
+import re
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from itertools import islice
+from math import ceil
+from threading import Lock
+from typing import Iterable, Iterator
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
 
 import requests
 
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from ecospheres.cache import ResponseCache
+from ecospheres.serialization import dumps, loads
+
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+# statuses of an object that does not exist, any other error is a failure to check it
+MISSING_STATUSES = (404, 410)
+
+# collection of an object or listing endpoint, e.g. /api/2/topics of /api/2/topics/{id}/
+COLLECTION = re.compile(r"^(/api/\d+/[\w-]+)(/|$)")
+
+# pages of a listing fetched ahead by `iter_pages`
+PREFETCH = 4
+
+# fields sent back when writing a topic or its elements, others are computed by data.gouv
+TOPIC_FIELDS = ["name", "description", "tags", "spatial", "private", "extras"]
+ELEMENT_FIELDS = ["title", "description", "tags", "extras", "element"]
+
+
+def page_url(url: str, page: int) -> str:
+    parts = urlsplit(url)
+    query = dict(parse_qsl(parts.query))
+    query["page"] = str(page)
+    return urlunsplit(parts._replace(query=urlencode(query)))
+
+
 class DatagouvfrAPI:
 
-    def __init__(self, url: str, authenticated: bool = True):
+    def __init__(
+        self,
+        url: str,
+        authenticated: bool = True,
+        pool_size: int = 10,
+        timeout: float = 30,
+        retries: int = 5,
+        backoff_factor: float = 0.5,
+        cache: ResponseCache | None = None,
+    ):
         self.api_key: str | None = None
         if authenticated:
             if not (api_key := os.getenv("DATAGOUVFR_API_KEY")):
                 raise Exception("Missing env var DATAGOUVFR_API_KEY.")
             self.api_key = api_key
         self.base_url: str = url
+        self.timeout: float = timeout
+        self.cache: ResponseCache | None = cache
+        self.session: requests.Session = self.make_session(pool_size, retries, backoff_factor)
+        self.pool_size: int = pool_size
+        # dataset id -> existence probe, shared by all the calls to `datasets_exist`
+        self._datasets_exist: dict[str, Future] = {}
+        self._datasets_lock = Lock()
         print(f"API ready for {self.base_url}")
 
+    @staticmethod
+    def make_session(pool_size: int, retries: int, backoff_factor: float) -> requests.Session:
+        """
+        Build a keep-alive session shared by all calls.
+
+        Idempotent requests are retried with exponential backoff on 429/5xx, honoring
+        `Retry-After`. POST is never retried to avoid creating duplicates. Once retries
+        are exhausted the last response is returned, so `raise_for_status` and `r.ok`
+        keep working as before.
+        """
+        retry = Retry(
+            total=retries,
+            status_forcelist=RETRY_STATUSES,
+            backoff_factor=backoff_factor,
+            respect_retry_after_header=True,
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+        session = requests.Session()
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        return session
+
     @property
     def headers(self):
         return {"x-api-key": self.api_key} if self.api_key else {}
@@ -21,35 +96,168 @@ class DatagouvfrAPI:
         return f"{self.base_url}{endpoint}"
 
     def _get(self, endpoint: str, **kwargs):
-        return requests.get(endpoint if "://" in endpoint else self.url(endpoint), **kwargs)
+        kwargs.setdefault("timeout", self.timeout)
+        return self.session.get(endpoint if "://" in endpoint else self.url(endpoint), **kwargs)
+
+    def get(self, endpoint: str, fields: str | None = None, **kwargs) -> dict:
+        """
+        GET a JSON payload, through the cache if any.
+
+        `fields` is an `X-Fields` mask, e.g. `id,title,resources{id,url}`: only these
+        fields are returned by data.gouv.
+        """
+        headers = {**self.headers, **({"X-Fields": fields} if fields else {})}
+        if not self.cache:
+            r = self._get(endpoint, **kwargs, headers=headers)
+            r.raise_for_status()
+            return loads(r.content)
 
-    def get(self, endpoint: str, **kwargs) -> dict:
-        r = self._get(endpoint, **kwargs, headers=self.headers)
+        url = endpoint if "://" in endpoint else self.url(endpoint)
+        # authenticated responses may include private objects, don't mix them up
+        key = self.cache.key(
+            url, kwargs.get("params"), {"authenticated": bool(self.api_key), "fields": fields}
+        )
+        entry = self.cache.lookup(key)
+        if entry and self.cache.is_fresh(entry):
+            return loads(entry.body)
+
+        r = self._get(url, **kwargs, headers={**headers, **(entry.validators if entry else {})})
+        if entry and r.status_code == 304:
+            self.cache.refresh(key)
+            return loads(entry.body)
         r.raise_for_status()
-        return r.json()
+        self.cache.store(key, r)
+        return loads(r.content)
 
-    def put(self, endpoint: str, **kwargs) -> dict:
-        r = requests.put(self.url(endpoint), headers=self.headers, **kwargs)
+    def iter_pages(self, endpoint: str, params: dict | None = None, fields: str | None = None,
+                   prefetch: int = PREFETCH) -> Iterator[dict]:
+        """
+        Yield the pages of a paginated endpoint, fetching up to `prefetch` pages ahead.
+
+        Page count is derived from `total` and `page_size` of the first page, pages are
+        still yielded in order. `fields` is the `X-Fields` mask of the items.
+        """
+        page_fields = f"data{{{fields}}},next_page,page,page_size,total" if fields else None
+        payload = self.get(endpoint, params=params, fields=page_fields)
+        yield payload
+        if not payload["next_page"]:
+            return
+
+        first_page = payload.get("page") or 1
+        last_page = ceil(payload["total"] / payload["page_size"])
+        urls = (page_url(payload["next_page"], p) for p in range(first_page + 1, last_page + 1))
+
+        executor = ThreadPoolExecutor(max_workers=prefetch)
+        try:
+            pending = deque(
+                executor.submit(self.get, url, fields=page_fields) for url in islice(urls, prefetch)
+            )
+            while pending:
+                page = pending.popleft().result()
+                if url := next(urls, None):
+                    pending.append(executor.submit(self.get, url, fields=page_fields))
+                yield page
+        finally:
+            executor.shutdown(cancel_futures=True)
+
+    def _write(self, method: str, endpoint: str, **kwargs) -> dict:
+        kwargs.setdefault("timeout", self.timeout)
+        headers = self.headers
+        if "json" in kwargs:
+            kwargs["data"] = dumps(kwargs.pop("json"))
+            headers = {**headers, "Content-Type": "application/json"}
+        r = self.session.request(method, self.url(endpoint), headers=headers, **kwargs)
         r.raise_for_status()
-        return r.json()
+        payload = loads(r.content)
+        if self.cache:
+            self.invalidate(endpoint, payload)
+        return payload
+
+    def invalidate(self, endpoint: str, payload: dict):
+        """
+        Drop the cached reads a write to `endpoint` may have changed: the written URL,
+        the object by id and by slug (with its elements), and the listing pages of its
+        collection, e.g. `/api/2/topics?tag=...`.
+        """
+        self.cache.invalidate(self.url(endpoint))
+        if not (match := COLLECTION.match(endpoint)):
+            return
+        collection = match[1]
+        for key in (payload.get("id"), payload.get("slug")):
+            if key:
+                self.cache.invalidate(self.url(f"{collection}/{key}"))
+        self.cache.invalidate(self.url(collection), below=False)
+
+    def close(self):
+        self.session.close()
+        if self.cache:
+            self.cache.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def put(self, endpoint: str, **kwargs) -> dict:
+        return self._write("PUT", endpoint, **kwargs)
 
     def post(self, endpoint: str, **kwargs) -> dict:
-        r = requests.post(self.url(endpoint), headers=self.headers, **kwargs)
-        r.raise_for_status()
-        return r.json()
+        return self._write("POST", endpoint, **kwargs)
 
-    def get_topic(self, topic_id_or_slug: str) -> dict:
-        return self.get(f"/api/2/topics/{topic_id_or_slug}")
+    def get_topic(self, topic_id_or_slug: str, fields: str | None = None) -> dict:
+        return self.get(f"/api/2/topics/{topic_id_or_slug}", fields=fields)
 
-    def get_topics(self, universe_tag: str, include_private: bool = True) -> list:
-        LIMIT = 100
-        params = {"tag": universe_tag, "page_size": LIMIT}
+    def iter_topics(self, universe_tag: str, include_private: bool = True, fields: str | None = None,
+                    page_size: int = 100) -> Iterator[dict]:
+        params = {"tag": universe_tag, "page_size": page_size}
         if include_private:
             params["include_private"] = "yes"
-        r = self.get(
-            "/api/2/topics",
-            params=params,
-        )
-        data = r["data"]
-        assert len(data) < LIMIT, "Too many topics"
-        return data
+        for page in self.iter_pages("/api/2/topics", params=params, fields=fields):
+            yield from page["data"]
+
+    def get_topics(self, universe_tag: str, include_private: bool = True, fields: str | None = None) -> list:
+        return list(self.iter_topics(universe_tag, include_private=include_private, fields=fields))
+
+    def _probe_dataset(self, dataset_id: str) -> int:
+        """Status of the dataset: 2xx if it exists, 404 or 410 if not. Other errors are raised."""
+        r = self._get(f"/api/2/datasets/{dataset_id}/", headers={"X-Fields": "id"})
+        if r.status_code not in MISSING_STATUSES:
+            r.raise_for_status()
+        return r.status_code
+
+    def dataset_statuses(self, ids: Iterable[str], max_workers: int | None = None) -> dict[str, int]:
+        """
+        Status of each dataset, see `_probe_dataset`, probing the unknown ones concurrently,
+        with up to `max_workers` threads (the size of the connection pool by default).
+
+        Answers, positive or negative, are memoized for the lifetime of this API
+        object, so an id is probed once however many topics or threads ask for it.
+        Failed probes are raised and forgotten, to be retried by the next call.
+        """
+        ids = list(dict.fromkeys(ids))
+        with ThreadPoolExecutor(max_workers=max_workers or self.pool_size) as executor:
+            with self._datasets_lock:
+                for dataset_id in ids:
+                    if dataset_id not in self._datasets_exist:
+                        self._datasets_exist[dataset_id] = executor.submit(self._probe_dataset, dataset_id)
+                probes = {dataset_id: self._datasets_exist[dataset_id] for dataset_id in ids}
+            statuses = {}
+            for dataset_id, probe in probes.items():
+                try:
+                    statuses[dataset_id] = probe.result()
+                except Exception:
+                    with self._datasets_lock:
+                        if self._datasets_exist.get(dataset_id) is probe:
+                            del self._datasets_exist[dataset_id]
+                    raise
+            return statuses
+
+    def datasets_exist(self, ids: Iterable[str]) -> dict[str, bool]:
+        return {
+            dataset_id: status not in MISSING_STATUSES
+            for dataset_id, status in self.dataset_statuses(ids).items()
+        }
+
+    def dataset_exists(self, dataset_id: str) -> bool:
+        return self.datasets_exist([dataset_id])[dataset_id]
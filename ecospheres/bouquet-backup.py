@@ -1,59 +1,345 @@
-import json
+import os
+import shutil
+import sys
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime
 from pathlib import Path
+
+import requests
 from minicli import cli, run
 
-from ecospheres.api import DatagouvfrAPI
+from ecospheres.api import MISSING_STATUSES, DatagouvfrAPI
+from ecospheres.cache import open_cache
 from ecospheres.config import get_page_config
-from ecospheres.rel import iter_rel
+from ecospheres.models import Element, Topic, parse_datetime
+from ecospheres.rel import iter_rel_concurrent, pool_size
+from ecospheres.serialization import dump, load
+from ecospheres.store import BackupStore
 
+MANIFEST = "manifest.json"
+# fields of the listed bouquets read by the backup, full payloads are fetched one by one
+LISTED_FIELDS = "id,name,last_modified"
+# name of the backup directories and snapshots
+TIMESTAMP = "%Y%m%d_%H%M%S"
 
-@cli
-def backup(env: str, site: str = "ecospheres", page: str = "bouquets"):
+
+def is_backup_name(name: str) -> bool:
+    try:
+        datetime.strptime(name, TIMESTAMP)
+        return True
+    except ValueError:
+        return False
+
+
+def find_previous_backup(base_dir: Path) -> Path | None:
+    """Most recent backup directory holding a manifest, restored snapshots aside"""
+    if not base_dir.exists():
+        return None
+    candidates = sorted(d for d in base_dir.iterdir() if is_backup_name(d.name) and (d / MANIFEST).exists())
+    return candidates[-1] if candidates else None
+
+
+def read_manifest(backup_dir: Path) -> dict:
+    with open(backup_dir / MANIFEST, "rb") as f:
+        return load(f)
+
+
+def fetch_bouquet(api: DatagouvfrAPI, bouquet_id: str) -> tuple[dict, list]:
+    full_bouquet = api.get_topic(bouquet_id)
+    elements = list(iter_rel_concurrent(full_bouquet["elements"], api))
+    return full_bouquet, elements
+
+
+def is_unchanged(previous: dict | None, topic: Topic) -> bool:
+    """Whether a manifest entry is up to date with a listed bouquet"""
+    if not previous or topic.last_modified is None:
+        return False
+    return parse_datetime(previous["last_modified"]) == topic.last_modified
+
+
+def manifest_entry(topic: Topic) -> dict:
+    last_modified = topic.last_modified.isoformat() if topic.last_modified else None
+    return {"name": topic.name, "last_modified": last_modified}
+
+
+def link_or_copy(source: Path, destination: Path):
+    try:
+        os.link(source, destination)
+    except OSError:
+        shutil.copy2(source, destination)
+
+
+@cli("compression", choices=["none", "gzip", "zstd"])
+def backup(env: str, site: str = "ecospheres", page: str = "bouquets", cache_dir: str = "",
+           incremental: bool = False, store: bool = False, compression: str = "gzip",
+           compact: bool = False):
     """
     Backup bouquets for a given environment and site
 
     Creates backup/{site}/{env}/ directory and saves each bouquet payload as JSON
     with filename being the bouquet ID and its elements in a separate file.
+    A manifest.json records the `last_modified` of each backed up bouquet.
+
+    In incremental mode, bouquets whose `last_modified` matches the manifest of the
+    previous backup are hard-linked from it instead of being downloaded again.
+    Elements edited without touching their bouquet are not detected this way, so a
+    full backup should still be made from time to time.
+
+    In store mode, payloads are saved in the content-addressed store in
+    backup/{site}/{env}/store/ and the backup is a snapshot referencing them, so
+    unchanged bouquets cost no disk space.
 
     :env: Target environment (demo, prod, or config file path)
     :site: Site name (default: ecospheres)
     :page: Page name (default: bouquets)
+    :cache_dir: Directory of the on-disk HTTP cache (disabled if empty)
+    :incremental: Only download bouquets changed since the previous backup
+    :store: Save the backup as a snapshot of the content-addressed store
+    :compression: Compression of the store objects (none, gzip or zstd)
+    :compact: Write the JSON files without indentation (smaller and faster)
     """
     config = get_page_config(site, env, page)
-    api = DatagouvfrAPI(config.base_url, authenticated=True)
+    api = DatagouvfrAPI(config.base_url, authenticated=True, cache=open_cache(cache_dir))
+
+    base_dir = Path("backup") / site / env
+    if store:
+        backup_store = BackupStore(base_dir / "store", compression)
+        return backup_to_store(api, config.universe_query["tag"], backup_store, incremental)
+
+    previous_dir = find_previous_backup(base_dir) if incremental else None
+    previous_manifest = read_manifest(previous_dir) if previous_dir else {}
+    if previous_dir:
+        print(f"Incremental backup from {previous_dir}")
 
     # Create backup directory
-    backup_dir = Path("backup") / site / env / datetime.now().strftime("%Y%m%d_%H%M%S")
+    backup_dir = base_dir / datetime.now().strftime(TIMESTAMP)
     backup_dir.mkdir(parents=True, exist_ok=True)
 
-    # Get all bouquets including private ones
+    # Stream all bouquets including private ones
     universe_tag = config.universe_query["tag"]
-    bouquets = api.get_topics(universe_tag, include_private=True)
+    bouquets = api.iter_topics(universe_tag, include_private=True, fields=LISTED_FIELDS)
 
-    print(f"Found {len(bouquets)} bouquets for {site} on {env}")
+    manifest = {}
 
     # Backup each bouquet
-    for bouquet in bouquets:
-        bouquet_id = bouquet["id"]
+    for bouquet in map(Topic.from_payload, bouquets):
+        bouquet_id = bouquet.id
+        filename = backup_dir / f"{bouquet_id}.json"
+        elements_filename = backup_dir / f"{bouquet_id}-elements.json"
+        manifest[bouquet_id] = manifest_entry(bouquet)
 
-        # Get full bouquet payload
-        full_bouquet = api.get_topic(bouquet_id)
+        if is_unchanged(previous_manifest.get(bouquet_id), bouquet):
+            previous_files = [previous_dir / filename.name, previous_dir / elements_filename.name]
+            if all(path.exists() for path in previous_files):
+                link_or_copy(previous_files[0], filename)
+                link_or_copy(previous_files[1], elements_filename)
+                print(f"Unchanged: {bouquet.name} -> linked from {previous_dir}")
+                continue
+            # pruned or moved since, fetched again below
+            print(f"Unchanged: {bouquet.name}, but missing from {previous_dir}")
+
+        # Get full bouquet payload and related elements
+        full_bouquet, elements = fetch_bouquet(api, bouquet_id)
 
         # Save bouquet to main file
-        filename = backup_dir / f"{bouquet_id}.json"
-        with open(filename, "w") as f:
-            json.dump(full_bouquet, f, indent=2, ensure_ascii=False)
+        with open(filename, "wb") as f:
+            dump(full_bouquet, f, indent=not compact)
 
-        # Get and save related elements
-        elements = list(iter_rel(full_bouquet["elements"], api))
-        elements_filename = backup_dir / f"{bouquet_id}-elements.json"
-        with open(elements_filename, "w") as f:
-            json.dump(elements, f, indent=2, ensure_ascii=False)
+        # Save related elements
+        with open(elements_filename, "wb") as f:
+            dump(elements, f, indent=not compact)
+
+        print(f"Backed up: {bouquet.name} ({len(elements)} elements) -> {filename} + {elements_filename}")
+
+    with open(backup_dir / MANIFEST, "wb") as f:
+        dump(manifest, f, indent=True)
+
+    print(f"Backup of {len(manifest)} bouquets for {site} on {env} completed in {backup_dir}")
+
+
+def backup_to_store(api: DatagouvfrAPI, universe_tag: str, store: BackupStore, incremental: bool):
+    snapshots = store.snapshots()
+    previous_manifest = store.read_snapshot(snapshots[-1]) if incremental and snapshots else {}
+    if previous_manifest:
+        print(f"Incremental backup from snapshot {snapshots[-1]}")
+
+    manifest = {}
+    for payload in api.iter_topics(universe_tag, include_private=True, fields=LISTED_FIELDS):
+        bouquet = Topic.from_payload(payload)
+        bouquet_id = bouquet.id
+        previous = previous_manifest.get(bouquet_id)
+        if is_unchanged(previous, bouquet):
+            if store.find(previous["topic"]) and store.find(previous["elements"]):
+                manifest[bouquet_id] = previous
+                print(f"Unchanged: {bouquet.name}")
+                continue
+            print(f"Unchanged: {bouquet.name}, but missing from the store")
+
+        full_bouquet, elements = fetch_bouquet(api, bouquet_id)
+        manifest[bouquet_id] = {
+            **manifest_entry(bouquet),
+            "topic": store.put(full_bouquet),
+            "elements": store.put(elements),
+        }
+        print(f"Backed up: {bouquet.name} ({len(elements)} elements)")
+
+    name = datetime.now().strftime(TIMESTAMP)
+    store.write_snapshot(name, manifest)
+    print(f"Snapshot {name} of {len(manifest)} bouquets completed in {store.root}")
+
+
+@cli
+def snapshots(env: str, site: str = "ecospheres"):
+    """
+    List the snapshots of the content-addressed store
+
+    :env: Target environment (demo, prod, or config file path)
+    :site: Site name (default: ecospheres)
+    """
+    store = BackupStore(Path("backup") / site / env / "store")
+    for name in store.snapshots():
+        print(f"{name}: {len(store.read_snapshot(name))} bouquets")
+
+
+@cli
+def restore_snapshot(env: str, snapshot: str, site: str = "ecospheres", destination: str = ""):
+    """
+    Restore a snapshot of the content-addressed store as a plain backup directory
+
+    :env: Target environment (demo, prod, or config file path)
+    :snapshot: Snapshot name, as listed by the `snapshots` command
+    :site: Site name (default: ecospheres)
+    :destination: Output directory (default: backup/{site}/{env}/restored-{snapshot})
+    """
+    base_dir = Path("backup") / site / env
+    store = BackupStore(base_dir / "store")
+    manifest = store.read_snapshot(snapshot)
+
+    # apart from the backups, which share the snapshot names, and not an incremental base
+    backup_dir = Path(destination) if destination else base_dir / f"restored-{snapshot}"
+    backup_dir.mkdir(parents=True, exist_ok=False)
+    for bouquet_id, entry in manifest.items():
+        with open(backup_dir / f"{bouquet_id}.json", "wb") as f:
+            dump(store.get(entry["topic"]), f, indent=True)
+        with open(backup_dir / f"{bouquet_id}-elements.json", "wb") as f:
+            dump(store.get(entry["elements"]), f, indent=True)
+
+    with open(backup_dir / MANIFEST, "wb") as f:
+        dump(
+            {k: {"name": v["name"], "last_modified": v["last_modified"]} for k, v in manifest.items()},
+            f, indent=True,
+        )
+    print(f"Restored snapshot {snapshot} ({len(manifest)} bouquets) in {backup_dir}")
+
+
+@cli
+def gc(env: str, site: str = "ecospheres", dry_run: bool = False):
+    """
+    Remove the store objects no snapshot references anymore
+
+    Delete snapshot files beforehand to release their objects.
+
+    :env: Target environment (demo, prod, or config file path)
+    :site: Site name (default: ecospheres)
+    :dry_run: Only report what would be removed
+    """
+    store = BackupStore(Path("backup") / site / env / "store")
+    count, size = store.gc(dry_run=dry_run)
+    print(f"{'Would remove' if dry_run else 'Removed'} {count} objects ({size} bytes)")
+
+
+def restore_payload(bouquet: dict, elements: list) -> dict:
+    payload = Topic.from_payload(bouquet).to_payload()
+    payload["elements"] = [Element.from_payload(e).to_payload() for e in elements]
+    return payload
+
+
+def restore_bouquet(api: DatagouvfrAPI, bouquet_path: Path, dry_run: bool) -> tuple[str, str]:
+    """Outcome (created, updated or unchanged) and report of the restore of a saved bouquet"""
+    with open(bouquet_path, "rb") as f:
+        saved_bouquet = load(f)
+    with open(bouquet_path.with_name(f"{bouquet_path.stem}-elements.json"), "rb") as f:
+        saved_elements = load(f)
+    payload = restore_payload(saved_bouquet, saved_elements)
+    label = f"{saved_bouquet['name']} ({saved_bouquet['id']})"
+
+    live = None
+    deleted = False
+    # a bouquet restored by a previous run has a new ID but most likely the same slug
+    for id_or_slug in (saved_bouquet["id"], saved_bouquet["slug"]):
+        try:
+            live = fetch_bouquet(api, id_or_slug)
+            break
+        except requests.exceptions.HTTPError as e:
+            if e.response.status_code not in MISSING_STATUSES:
+                raise e
+            # 410: deleted on the live side, recreated like a missing one
+            deleted = deleted or e.response.status_code == 410
+
+    if live is None:
+        # owner is only set on creation
+        for owner_field in ("organization", "owner"):
+            if saved_bouquet.get(owner_field):
+                payload[owner_field] = saved_bouquet[owner_field]
+                break
+        if deleted:
+            label = f"{label}, deleted on the live side"
+        if dry_run:
+            return "created", f"Would create: {label}"
+        created = api.post("/api/2/topics/", json=payload)
+        return "created", f"Created: {label} -> {created['id']}"
+
+    live_bouquet, live_elements = live
+    live_payload = restore_payload(live_bouquet, live_elements)
+    changed = [k for k in payload if payload[k] != live_payload[k]]
+    if not changed:
+        return "unchanged", f"Unchanged: {label}"
+    if dry_run:
+        return "updated", f"Would update: {label} ({', '.join(changed)})"
+    api.put(f"/api/2/topics/{live_bouquet['id']}/", json=payload)
+    return "updated", f"Updated: {label} ({', '.join(changed)})"
+
+
+@cli
+def restore(backup_dir: str, env: str, site: str = "ecospheres", page: str = "bouquets",
+            dry_run: bool = False, concurrency: int = 4):
+    """
+    Restore the bouquets of a backup directory
+
+    Each saved bouquet and its elements are compared to the live bouquet, only the
+    bouquets that differ are updated, and the missing ones are created (with a new ID).
+    Running it twice is harmless.
+
+    :backup_dir: Backup directory, e.g. backup/ecospheres/prod/20250101_120000
+    :env: Target environment (demo, prod, or config file path)
+    :site: Site name (default: ecospheres)
+    :page: Page name (default: bouquets)
+    :dry_run: Only report what would be restored
+    :concurrency: Maximum number of bouquets restored in parallel
+    """
+    config = get_page_config(site, env, page)
+    api = DatagouvfrAPI(config.base_url, authenticated=True, pool_size=pool_size(concurrency))
+
+    paths = sorted(p for p in Path(backup_dir).glob("*.json")
+                   if p.name != MANIFEST and not p.stem.endswith("-elements"))
+    print(f"Found {len(paths)} bouquets in {backup_dir}")
 
-        print(f"Backed up: {bouquet['name']} ({len(elements)} elements) -> {filename} + {elements_filename}")
+    counts = {"created": 0, "updated": 0, "unchanged": 0, "failed": 0}
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = {executor.submit(restore_bouquet, api, path, dry_run): path for path in paths}
+        for future in as_completed(futures):
+            try:
+                outcome, message = future.result()
+                print(message)
+                counts[outcome] += 1
+            except Exception as e:
+                print(f"⚠ Failed to restore {futures[future].name}: {e}")
+                counts["failed"] += 1
 
-    print(f"Backup completed in {backup_dir}")
+    print(f"{'Dry run of the restore' if dry_run else 'Restore'} of {len(paths)} bouquets: {counts['created']} created, "
+          f"{counts['updated']} updated, {counts['unchanged']} unchanged, {counts['failed']} failed")
+    if counts["failed"]:
+        sys.exit(1)
 
 
 if __name__ == "__main__":
@@ -1,17 +1,26 @@
-import csv
-
-from collections.abc import Sequence, Mapping
-from dataclasses import asdict, dataclass, fields
+from collections.abc import Iterator
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager, ExitStack
+from dataclasses import dataclass
 from datetime import datetime
 from minicli import cli, run
 from pathlib import Path
-from typing import Any, Optional
+from threading import Lock
 
 from ecospheres.api import DatagouvfrAPI
-from ecospheres.rel import iter_rel
+from ecospheres.cache import open_cache
+from ecospheres.models import Author, Dataset, Element, Topic, maybe_get
+from ecospheres.rel import iter_rel_concurrent, pool_size
+from ecospheres.tables import EXTENSIONS, TableWriter, open_table
+
+# X-Fields mask of the bouquets: only the fields read by the export are requested
+BOUQUET_FIELDS = (
+    f"id,name,description,last_modified,spatial{{zones}},elements{{href}},"
+    f"organization{{{Author.FIELDS}}},owner{{{Author.FIELDS}}}"
+)
 
 
-@dataclass
+@dataclass(slots=True)
 class Bouquet:
     bouquet_id: str
     bouquet_name: str
@@ -22,7 +31,7 @@ class Bouquet:
     bouquet_spatial_coverage: str | None
 
 
-@dataclass
+@dataclass(slots=True)
 class Factor:
     bouquet_id: str
     factor_id: str
@@ -46,134 +55,222 @@ class Factor:
     dataset_quality_score: float | None = None
 
 
-@dataclass
+@dataclass(slots=True)
 class Resource:
     dataset_id: str
     resource_id: str
-    resource_available: str | None
+    resource_available: bool | None
     resource_title: str
     resource_type: str
     resource_format: str
     resource_schema: str | None
 
 
-def fieldnames(class_or_instance) -> list[str]:
-    return [field.name for field in fields(class_or_instance)]
-
-
-def maybe_get(payload: Mapping | Sequence, *path) -> Optional[Any]:
-    for p in path:
-        if not hasattr(payload, "__getitem__"):
-            return None
-        try:
-            payload = payload[p]
-        except (IndexError, KeyError):
-            return None
-        if not payload:
-            return None
-    return payload  # type: ignore
+class DatasetCache:
+    """Fetch each dataset at most once per run, even when requested from several threads"""
+
+    def __init__(self, api: DatagouvfrAPI, executor: ThreadPoolExecutor):
+        self.api = api
+        self.executor = executor
+        self._futures: dict[str, Future] = {}
+        self._lock = Lock()
+
+    def fetch(self, dataset_id: str) -> Future:
+        with self._lock:
+            if dataset_id not in self._futures:
+                self._futures[dataset_id] = self.executor.submit(self._fetch, dataset_id)
+            return self._futures[dataset_id]
+
+    def _fetch(self, dataset_id: str) -> Dataset:
+        return Dataset.from_payload(self.api.get(f"/api/1/datasets/{dataset_id}", fields=Dataset.FIELDS))
+
+
+@dataclass(slots=True)
+class BouquetExport:
+    bouquet: Bouquet
+    factors: list[Factor]
+    resources: list[Resource]
+
+
+def make_factor(bouquet_id: str, factor_index: int, element: Element) -> Factor:
+    site_extras = element.site_extras("ecospheres")
+    factor = Factor(
+        bouquet_id=bouquet_id,
+        factor_id=element.id,
+        factor_index=factor_index,
+        factor_group=site_extras.get("group"),
+        factor_availability=site_extras["availability"],
+        factor_title=element.title,
+        factor_purpose=element.description,
+    )
+
+    if factor.factor_availability == "url available":
+        factor.dataset_url = site_extras["uri"]
+
+    elif factor.factor_availability == "available":
+        factor.dataset_id = element.dataset_id
+
+    return factor
+
+
+def enrich_factor(factor: Factor, dataset: Dataset):
+    factor.dataset_url = dataset.page
+    factor.dataset_title = dataset.title
+    factor.dataset_author_name = dataset.author.name if dataset.author else None
+    factor.dataset_author_page = dataset.author.page if dataset.author else None
+    # factor.dataset_responsible_parties =
+    factor.dataset_last_modified = dataset.last_modified
+    factor.dataset_license = dataset.license
+    # factor.dataset_spatial_coverage =
+    # factor.dataset_temporal_coverage =
+    # factor.dataset_update_frequency =
+    factor.dataset_schema = dataset.schema
+    factor.dataset_quality_score = dataset.quality_score
+
+
+def make_resources(dataset: Dataset) -> Iterator[Resource]:
+    for resource in dataset.resources:
+        yield Resource(
+            dataset_id=dataset.id,
+            resource_id=resource.id,
+            resource_available=resource.available,
+            resource_title=resource.title,
+            resource_type=resource.type,
+            resource_format=resource.format,
+            resource_schema=resource.schema,
+        )
 
 
-def get_author(payload: dict[str, Any]) -> dict[str, Any]:
-    return payload["organization"] or payload["owner"] or {}
+def make_bouquet(topic: Topic) -> Bouquet:
+    author = topic.author
+    return Bouquet(
+        bouquet_id=topic.id,
+        bouquet_name=topic.name,
+        bouquet_description=topic.description,
+        bouquet_author_name=author.name if author else None,
+        bouquet_author_page=author.page if author else None,
+        bouquet_last_modified=topic.last_modified,
+        bouquet_spatial_coverage=maybe_get(topic.spatial, "zones", 0)
+    )
+
+
+def collect_bouquet(api: DatagouvfrAPI, topic: Topic, datasets: DatasetCache) -> BouquetExport:
+    elements = iter_rel_concurrent(topic.elements, api, fields=Element.FIELDS)
+    factors = [
+        make_factor(topic.id, factor_index, Element.from_payload(element_payload))
+        for factor_index, element_payload in enumerate(elements, start=1)
+    ]
+
+    # Request all referenced datasets up front, then resolve them in factor order
+    futures = {f.dataset_id: datasets.fetch(f.dataset_id) for f in factors if f.dataset_id}
+
+    resources = []
+    collected = set()
+    for factor in factors:
+        if factor.dataset_id:
+            dataset = futures[factor.dataset_id].result()
+            enrich_factor(factor, dataset)
+            if factor.dataset_id not in collected:
+                resources.extend(make_resources(dataset))
+                collected.add(factor.dataset_id)
+
+    return BouquetExport(make_bouquet(topic), factors, resources)
+
+
+@contextmanager
+def table_writers(path: Path,
+                  table_format: str = "csv") -> Iterator[tuple[TableWriter, TableWriter, TableWriter]]:
+    with ExitStack() as stack:
+        yield tuple(
+            stack.enter_context(open_table(path.joinpath(name), row_class, table_format))
+            for name, row_class in (("bouquet", Bouquet), ("factors", Factor), ("resources", Resource))
+        )
 
 
-def get_schema(payload: dict[str, Any]) -> str | None:
-    schema = payload.get("schema")
-    if not schema:
-        return None
-    label = schema.get("url") or schema.get("name")
-    if not label:
-        return None
-    version = schema.get("version")
-    return f"{label} (version {version})" if version else label
+def write_export(writers: tuple[TableWriter, TableWriter, TableWriter],
+                 bouquet_export: BouquetExport, seen_datasets: set[str]):
+    bouquet_table, factors_table, resources_table = writers
+    bouquet_table.write([bouquet_export.bouquet])
+    factors_table.write(bouquet_export.factors)
+    # a dataset's resources are written once, whichever bouquet references it first
+    resources_table.write(
+        resource for resource in bouquet_export.resources
+        if resource.dataset_id not in seen_datasets
+    )
+    seen_datasets.update(resource.dataset_id for resource in bouquet_export.resources)
 
 
 @cli("env", choices=["www", "demo"])
-def export(id_or_slug: str, env: str = "www"):
+@cli("table_format", name="format", choices=list(EXTENSIONS))
+def export(id_or_slug: str, env: str = "www", concurrency: int = 10, cache_dir: str = "",
+           table_format: str = "csv"):
     """Export a bouquet
 
     Will export the bouquet in directory `bouquet--{id_or_slug}`.
 
     :id_or_slug: Identifier or slug of the bouquet
     :env: Target data.gouv environment
+    :concurrency: Maximum number of datasets fetched in parallel
+    :cache_dir: Directory of the on-disk HTTP cache (disabled if empty)
+    :table_format: Format of the exported tables (csv, ndjson, parquet or arrow)
     """
-    api = DatagouvfrAPI(url=f"https://{env}.data.gouv.fr", authenticated=False)
-    bouquet_payload = api.get_topic(id_or_slug)
+    api = DatagouvfrAPI(url=f"https://{env}.data.gouv.fr", authenticated=False, pool_size=concurrency,
+                         cache=open_cache(cache_dir))
+    topic = Topic.from_payload(api.get_topic(id_or_slug, fields=BOUQUET_FIELDS))
 
     path = Path(f"bouquet--{id_or_slug}")
     path.mkdir(exist_ok=False)
 
-    with (open(path.joinpath("bouquet.csv"), "w") as bouquet_file,
-          open(path.joinpath("factors.csv"), mode="w") as factors_file,
-          open(path.joinpath("resources.csv"), mode="w") as resources_file):
-        bouquet_csv = csv.DictWriter(bouquet_file, fieldnames=fieldnames(Bouquet))
-        factors_csv = csv.DictWriter(factors_file, fieldnames=fieldnames(Factor))
-        resources_csv = csv.DictWriter(resources_file, fieldnames=fieldnames(Resource))
-
-        bouquet_csv.writeheader()
-        factors_csv.writeheader()
-        resources_csv.writeheader()
-
-        bouquet_author = get_author(bouquet_payload)
-        bouquet = Bouquet(
-            bouquet_id=bouquet_payload["id"],
-            bouquet_name=bouquet_payload["name"],
-            bouquet_description=bouquet_payload.get("description"),
-            bouquet_author_name=bouquet_author["name"],
-            bouquet_author_page=bouquet_author["page"],
-            bouquet_last_modified=datetime.fromisoformat(bouquet_payload["last_modified"]),
-            bouquet_spatial_coverage=maybe_get(bouquet_payload, "spatial", "zones", 0)
+    with (api,
+          ThreadPoolExecutor(max_workers=concurrency) as executor,
+          table_writers(path, table_format) as writers):
+        bouquet_export = collect_bouquet(api, topic, DatasetCache(api, executor))
+        write_export(writers, bouquet_export, set())
+
+
+@cli("env", choices=["www", "demo"])
+@cli("table_format", name="format", choices=list(EXTENSIONS))
+def export_all(universe_tag: str, env: str = "www", concurrency: int = 10, bouquets_concurrency: int = 4,
+               cache_dir: str = "", table_format: str = "csv"):
+    """Export all the public bouquets of a universe
+
+    Will export the bouquets in directory `bouquets--{universe_tag}`, as a single set
+    of tables. Datasets shared between bouquets are only fetched once.
+
+    :universe_tag: Tag identifying the universe bouquets
+    :env: Target data.gouv environment
+    :concurrency: Maximum number of datasets fetched in parallel
+    :bouquets_concurrency: Maximum number of bouquets processed in parallel
+    :cache_dir: Directory of the on-disk HTTP cache (disabled if empty)
+    :table_format: Format of the exported tables (csv, ndjson, parquet or arrow)
+    """
+    api = DatagouvfrAPI(
+        url=f"https://{env}.data.gouv.fr",
+        authenticated=False,
+        pool_size=pool_size(bouquets_concurrency, concurrency),
+        cache=open_cache(cache_dir),
+    )
+    bouquets = [
+        Topic.from_payload(payload)
+        for payload in api.iter_topics(universe_tag, include_private=False, fields=BOUQUET_FIELDS)
+    ]
+    print(f"Found {len(bouquets)} bouquets for {universe_tag} on {env}")
+
+    path = Path(f"bouquets--{universe_tag}")
+    path.mkdir(exist_ok=False)
+
+    with (api,
+          ThreadPoolExecutor(max_workers=concurrency) as datasets_executor,
+          ThreadPoolExecutor(max_workers=bouquets_concurrency) as bouquets_executor,
+          table_writers(path, table_format) as writers):
+        datasets = DatasetCache(api, datasets_executor)
+        seen_datasets: set[str] = set()
+        bouquet_exports = bouquets_executor.map(
+            lambda topic: collect_bouquet(api, topic, datasets), bouquets
         )
-        bouquet_csv.writerow(asdict(bouquet))
-
-        elements = iter_rel(bouquet_payload["elements"], api)
-
-        for factor_index, factor_payload in enumerate(elements, start=1):
-            factor = Factor(
-                bouquet_id=bouquet_payload["id"],
-                factor_id=factor_payload["id"],
-                factor_index=factor_index,
-                factor_group=factor_payload["extras"]["ecospheres"].get("group"),
-                factor_availability=factor_payload["extras"]["ecospheres"]["availability"],
-                factor_title=factor_payload["title"],
-                factor_purpose=factor_payload["description"],
-            )
-
-            if factor.factor_availability == "url available":
-                factor.dataset_url = factor_payload["extras"]["ecospheres"]["uri"]
-
-            elif factor.factor_availability == "available":
-                dataset_id = factor_payload["element"]["id"]
-                dataset_payload = api.get(f"/api/1/datasets/{dataset_id}")
-                dataset_author = get_author(dataset_payload)
-                factor.dataset_id = dataset_id
-                factor.dataset_url = dataset_payload["page"]
-                factor.dataset_title = dataset_payload["title"]
-                factor.dataset_author_name = dataset_author["name"]
-                factor.dataset_author_page = dataset_author["page"]
-                # factor.dataset_responsible_parties =
-                factor.dataset_last_modified = datetime.fromisoformat(dataset_payload["last_modified"])
-                factor.dataset_license = dataset_payload.get("license")
-                # factor.dataset_spatial_coverage =
-                # factor.dataset_temporal_coverage =
-                # factor.dataset_update_frequency =
-                factor.dataset_schema = get_schema(dataset_payload)
-                factor.dataset_quality_score = maybe_get(dataset_payload, "quality", "score")
-
-                for resource_payload in dataset_payload.get("resources", []):
-                    resource = Resource(
-                        dataset_id=dataset_id,
-                        resource_id=resource_payload["id"],
-                        resource_available=maybe_get(resource_payload, "extras", "check:available"),
-                        resource_title=resource_payload["title"],
-                        resource_type=resource_payload["type"],
-                        resource_format=resource_payload.get("format"),
-                        resource_schema=get_schema(resource_payload),
-                    )
-                    resources_csv.writerow(asdict(resource))
-
-            factors_csv.writerow(asdict(factor))
+        for bouquet_export in bouquet_exports:
+            write_export(writers, bouquet_export, seen_datasets)
+            print(f"Exported: {bouquet_export.bouquet.bouquet_name} ({len(bouquet_export.factors)} factors)")
 
 
 if __name__ == "__main__":
@@ -3,28 +3,32 @@ import requests
 from minicli import cli, run
 
 from ecospheres.api import DatagouvfrAPI
+from ecospheres.cache import open_cache
 from ecospheres.config import get_page_config
-from ecospheres.rel import iter_rel
+from ecospheres.models import Element, Topic
+from ecospheres.rel import iter_rel_concurrent
 
 
 @cli
-def copy(slug: str, source: str = "prod", destination: str = "demo", site: str = "ecospheres", page: str = "bouquets"):
+def copy(slug: str, source: str = "prod", destination: str = "demo", site: str = "ecospheres", page: str = "bouquets", cache_dir: str = ""):
     """
     Copy a bouquet from one env to another
+
+    :cache_dir: Directory of the on-disk HTTP cache for source reads (disabled if empty)
     """
     print(f"Copying from {source} to {destination}")
 
     config_source = get_page_config(site, source, page)
     config_destination = get_page_config(site, destination, page)
 
-    api_source = DatagouvfrAPI(config_source.base_url, authenticated=False)
+    api_source = DatagouvfrAPI(config_source.base_url, authenticated=False, cache=open_cache(cache_dir))
     api_destination = DatagouvfrAPI(config_source.base_url)
 
-    source_data = api_source.get_topic(slug)
+    source = Topic.from_payload(api_source.get_topic(slug, fields=Topic.FIELDS))
 
     existing_id = None
     try:
-        r = api_destination.get_topic(slug)
+        r = api_destination.get_topic(slug, fields="id")
         confirm = input(f"{slug} already exists on {destination}, y to replace: ")
         if confirm.lower() != "y":
             return
@@ -36,42 +40,47 @@ def copy(slug: str, source: str = "prod", destination: str = "demo", site: str =
             raise e
 
     destination_data = {}
-    destination_data["tags"] = [config_destination.universe_query["tag"], *source_data["tags"]]
-    destination_data["name"] = source_data["name"]
-    destination_data["description"] = source_data["description"]
-    destination_data["spatial"] = source_data["spatial"]
-    destination_data["private"] = source_data["private"]
-
-    if source_data["owner"]:
-        r = api_destination._get(f"/api/1/users/{source_data['owner']['id']}/")
+    destination_data["tags"] = [config_destination.universe_query["tag"], *source.tags]
+    destination_data["name"] = source.name
+    destination_data["description"] = source.description
+    destination_data["spatial"] = source.spatial
+    destination_data["private"] = source.private
+
+    if source.owner:
+        r = api_destination._get(f"/api/1/users/{source.owner['id']}/")
         if r.ok:
-            destination_data["owner"] = source_data["owner"]
+            destination_data["owner"] = source.owner
         else:
             print(f"Owner does not exist on {destination}")
-    elif source_data["organization"]:
-        r = api_destination._get(f"/api/1/organization/{source_data['organization']['id']}/")
+    elif source.organization:
+        r = api_destination._get(f"/api/1/organization/{source.organization['id']}/")
         if r.ok:
-            destination_data["organization"] = source_data["organization"]
+            destination_data["organization"] = source.organization
         else:
             print(f"Organization does not exist on {destination}")
 
-    existing_elements = iter_rel(source_data["elements"], api_source)
+    existing_elements = [
+        Element.from_payload(payload)
+        for payload in iter_rel_concurrent(source.elements, api_source, fields=Element.FIELDS)
+    ]
+    exists = api_destination.datasets_exist(e.dataset_id for e in existing_elements if e.dataset_id)
 
     destination_data["elements"] = []
     for element in existing_elements:
-        if element_object := element.get("element"):
-            r = api_destination._get(f"/api/2/datasets/{element_object['id']}/")
-            if not r.ok:
-                print(f"{element_object['id']} not on {destination}, transforming to URL")
-                element["extras"] = {
-                    site: {
-                        "uri": f"{config_source.base_url}/datasets/{element_object['id']}/",
-                        "group": element["extras"][site].get("group"),
-                        "availability": "url available",
-                    },
-                    **element["extras"],
-                }
-        destination_data["elements"].append(element)
+        if element.dataset_id and not exists[element.dataset_id]:
+            print(f"{element.dataset_id} not on {destination}, transforming to URL")
+            # the URL extras of the site replace the source ones, and the element no longer
+            # references a dataset missing on the destination
+            element.extras = {
+                **element.extras,
+                site: {
+                    "uri": f"{config_source.base_url}/datasets/{element.dataset_id}/",
+                    "group": element.site_extras(site).get("group"),
+                    "availability": "url available",
+                },
+            }
+            element.element = None
+        destination_data["elements"].append(element.to_payload())
 
     if existing_id:
         r = api_destination.put(f"/api/2/topics/{existing_id}/", json=destination_data)
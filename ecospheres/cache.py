@@ -0,0 +1,145 @@
+import hashlib
+import json
+import sqlite3
+import time
+
+from dataclasses import dataclass
+from pathlib import Path
+from threading import Lock
+
+import requests
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS responses (
+    key TEXT PRIMARY KEY,
+    url TEXT NOT NULL,
+    etag TEXT,
+    last_modified TEXT,
+    body BLOB NOT NULL,
+    size INTEGER NOT NULL,
+    stored_at REAL NOT NULL,
+    accessed_at REAL NOT NULL
+)
+"""
+TTL = 3600
+
+
+@dataclass
+class CachedResponse:
+    body: bytes
+    etag: str | None
+    last_modified: str | None
+    stored_at: float
+
+    @property
+    def validators(self) -> dict[str, str]:
+        headers = {}
+        if self.etag:
+            headers["If-None-Match"] = self.etag
+        if self.last_modified:
+            headers["If-Modified-Since"] = self.last_modified
+        return headers
+
+
+class ResponseCache:
+    """
+    On-disk cache of GET responses, stored in a SQLite file.
+
+    Entries younger than `ttl` seconds are served without any request. Older entries
+    are revalidated with `If-None-Match`/`If-Modified-Since` when the server sent an
+    `ETag` or `Last-Modified`, and dropped otherwise. Least recently used entries are
+    evicted once the cache grows past `max_size` bytes.
+    """
+
+    def __init__(self, directory: str | Path, ttl: float = TTL, max_size: int = 500 * 1024 ** 2):
+        path = Path(directory)
+        path.mkdir(parents=True, exist_ok=True)
+        self.ttl = ttl
+        self.max_size = max_size
+        self._lock = Lock()
+        self._db = sqlite3.connect(path / "responses.sqlite", check_same_thread=False)
+        with self._db:
+            self._db.execute(SCHEMA)
+
+    @staticmethod
+    def key(url: str, params: dict | None = None, headers: dict | None = None) -> str:
+        """Key on the URL, the query params and the headers altering the payload"""
+        parts = [url, sorted((params or {}).items()), sorted((headers or {}).items())]
+        return hashlib.sha256(json.dumps(parts, default=str).encode()).hexdigest()
+
+    def is_fresh(self, entry: CachedResponse) -> bool:
+        return time.time() - entry.stored_at < self.ttl
+
+    def lookup(self, key: str) -> CachedResponse | None:
+        with self._lock, self._db:
+            row = self._db.execute(
+                "SELECT body, etag, last_modified, stored_at FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            if not row:
+                return None
+            entry = CachedResponse(*row)
+            if not self.is_fresh(entry) and not entry.validators:
+                self._db.execute("DELETE FROM responses WHERE key = ?", (key,))
+                return None
+            self._db.execute("UPDATE responses SET accessed_at = ? WHERE key = ?", (time.time(), key))
+            return entry
+
+    def refresh(self, key: str):
+        """Mark an entry as fresh again, after a 304 Not Modified"""
+        now = time.time()
+        with self._lock, self._db:
+            self._db.execute(
+                "UPDATE responses SET stored_at = ?, accessed_at = ? WHERE key = ?", (now, now, key)
+            )
+
+    def store(self, key: str, response: requests.Response):
+        now = time.time()
+        body = response.content
+        with self._lock, self._db:
+            self._db.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (key, response.url, response.headers.get("ETag"),
+                 response.headers.get("Last-Modified"), body, len(body), now, now),
+            )
+            self._evict()
+
+    def invalidate(self, url: str, below: bool = True):
+        """
+        Drop entries for `url`, with any query string, and unless `below` is False
+        everything below it (e.g. a topic and its elements)
+        """
+        prefix = url.rstrip("/")
+        conditions = ["url IN (?, ?)", "substr(url, 1, ?) = ?", "substr(url, 1, ?) = ?"]
+        params = [prefix, f"{prefix}/", len(prefix) + 1, f"{prefix}?", len(prefix) + 2, f"{prefix}/?"]
+        if below:
+            conditions.append("substr(url, 1, ?) = ?")
+            params += [len(prefix) + 1, f"{prefix}/"]
+        with self._lock, self._db:
+            self._db.execute(f"DELETE FROM responses WHERE {' OR '.join(conditions)}", params)
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _evict(self):
+        (total,) = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()
+        if total <= self.max_size:
+            return
+        rows = self._db.execute("SELECT key, size FROM responses ORDER BY accessed_at").fetchall()
+        evicted = []
+        for key, size in rows:
+            if total <= self.max_size:
+                break
+            evicted.append((key,))
+            total -= size
+        self._db.executemany("DELETE FROM responses WHERE key = ?", evicted)
+
+
+def open_cache(cache_dir: str, ttl: float = TTL) -> ResponseCache | None:
+    return ResponseCache(cache_dir, ttl=ttl) if cache_dir else None
@@ -0,0 +1,79 @@
+import time
+from pathlib import Path
+
+from minicli import cli, run
+
+from ecospheres.api import DatagouvfrAPI
+from ecospheres.serialization import BACKEND, BACKENDS
+
+SAMPLE_DATASETS = 50
+
+
+def fetch_samples(env: str, topic: str) -> list[bytes]:
+    """Raw bodies of a topic, its elements pages and the datasets it references"""
+    api = DatagouvfrAPI(url=f"https://{env}.data.gouv.fr", authenticated=False)
+
+    def raw(endpoint):
+        r = api._get(endpoint)
+        r.raise_for_status()
+        return r.content
+
+    samples = [raw(f"/api/2/topics/{topic}/")]
+    dataset_ids = []
+    url = api.get_topic(topic)["elements"]["href"]
+    while url:
+        samples.append(raw(url))
+        page = api.get(url)
+        dataset_ids.extend(e["element"]["id"] for e in page["data"] if e.get("element"))
+        url = page["next_page"]
+    samples.extend(raw(f"/api/1/datasets/{id}/") for id in dataset_ids[:SAMPLE_DATASETS])
+    return samples
+
+
+def timed(func, payloads, rounds: int) -> float:
+    """Best time of `rounds` passes over the payloads"""
+    best = float("inf")
+    for _ in range(rounds):
+        start = time.perf_counter()
+        for payload in payloads:
+            func(payload)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+@cli
+def bench(backup_dir: str = "", env: str = "www", topic: str = "", rounds: int = 20):
+    """
+    Compare the JSON backends available on real topic and dataset payloads
+
+    :backup_dir: Use the JSON files of a backup directory as payloads
+    :env: data.gouv environment to fetch the payloads from, if no backup_dir
+    :topic: Slug or id of the topic to fetch, with its elements and datasets
+    :rounds: Number of passes, the best one is kept
+    """
+    if backup_dir:
+        samples = [path.read_bytes() for path in sorted(Path(backup_dir).glob("*.json"))]
+    elif topic:
+        samples = fetch_samples(env, topic)
+    else:
+        raise ValueError("Either backup_dir or topic is required")
+    size = sum(len(s) for s in samples) / 1024 / 1024
+    print(f"{len(samples)} payloads, {size:.1f} MiB, default backend: {BACKEND}")
+
+    objects = [BACKENDS["json"][0](s) for s in samples]
+    print(f"{'backend':<8} {'decode MiB/s':>13} {'encode MiB/s':>13} {'indent MiB/s':>13}")
+    reference = None
+    for name, (loads, dumps) in BACKENDS.items():
+        times = (
+            timed(loads, samples, rounds),
+            timed(dumps, objects, rounds),
+            timed(lambda o: dumps(o, indent=True), objects, rounds),
+        )
+        reference = reference or times
+        print(f"{name:<8} " + " ".join(
+            f"{size / t:8.0f} x{r / t:<3.1f}" for t, r in zip(times, reference)
+        ))
+
+
+if __name__ == "__main__":
+    run()
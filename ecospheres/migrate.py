@@ -0,0 +1,86 @@
+from minicli import cli, run
+
+from ecospheres.migration import (
+    STATE_DIR, get_migration, load_migrations, read_ledger, rollback_migration, run_migration,
+)
+
+
+@cli
+def list_migrations():
+    """
+    List the migrations using the shared runner
+    """
+    for name, migration in sorted(load_migrations().items()):
+        print(f"{name}: {migration.description}")
+
+
+@cli
+def applied(env: str, site: str = "ecospheres", name: str = ""):
+    """
+    List the runs of the migrations on an environment, from the ledger
+
+    :env: Target environment (demo, prod, or config file path)
+    :site: Site name (default: ecospheres)
+    :name: Only list the runs of this migration
+    """
+    for entry in read_ledger(STATE_DIR / site / env):
+        if name and entry["migration"] != name:
+            continue
+        status = "complete" if entry["complete"] else "partial"
+        if entry.get("rollback"):
+            status = f"rollback, {status}"
+        scope = f" on {entry['slug']}" if entry["slug"] else ""
+        print(f"{entry['finished']} {entry['migration']}{scope} ({status}): {entry['updated']} updated, "
+              f"{entry['unchanged']} unchanged, {entry['failed']} failed")
+
+
+@cli
+def migrate(name: str, env: str = "demo", site: str = "ecospheres", page: str = "bouquets",
+            slug: str = "", dry_run: bool = False, restart: bool = False, concurrency: int = 8,
+            write_concurrency: int = 4, cache_dir: str = ""):
+    """
+    Run a registered migration with its default options
+
+    Topics already migrated by a previous (interrupted) run are skipped, see the
+    journal in migration-state/{site}/{env}/{name}.jsonl.
+
+    :name: Migration name, as listed by `list-migrations`
+    :env: Target environment (demo, prod, or config file path)
+    :site: Site name (default: ecospheres)
+    :page: Page name (default: bouquets)
+    :slug: Only migrate this topic
+    :dry_run: Print the diff of each topic instead of updating it
+    :restart: Migrate again the topics already migrated by previous runs
+    :concurrency: Maximum number of topics fetched and transformed in parallel
+    :write_concurrency: Maximum number of topics updated in parallel
+    :cache_dir: Directory of the on-disk HTTP cache (disabled if empty)
+    """
+    run_migration(
+        get_migration(name), env, site=site, page=page, slug=slug, dry_run=dry_run, restart=restart,
+        concurrency=concurrency, write_concurrency=write_concurrency, cache_dir=cache_dir,
+    )
+
+
+@cli
+def rollback(name: str, env: str = "demo", site: str = "ecospheres", page: str = "bouquets",
+             slug: str = "", dry_run: bool = False, write_concurrency: int = 4):
+    """
+    Roll back a migration, restoring the topics it updated from their journaled pre-images
+
+    Changes made to these topics after the migration are lost. Once rolled back,
+    the topics are migrated again by the next run of the migration.
+
+    :name: Migration name, as listed by `list-migrations`
+    :env: Target environment (demo, prod, or config file path)
+    :site: Site name (default: ecospheres)
+    :page: Page name (default: bouquets)
+    :slug: Only roll back this topic
+    :dry_run: Only list the topics that would be rolled back
+    :write_concurrency: Maximum number of topics updated in parallel
+    """
+    rollback_migration(name, env, site=site, page=page, slug=slug, dry_run=dry_run,
+                       write_concurrency=write_concurrency)
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,340 @@
+"""
+Shared runner for the topic migrations of `ecospheres/migrations/`
+
+A migration is a function turning a topic into the payload to PUT, or None when
+the topic needs no change, registered with the `migration` decorator:
+
+    @migration("20250912_1_fix_group_migration", elements=True)
+    def fix_groups(topic: dict, context: MigrationContext) -> dict | None:
+        ...
+
+The runner fetches the topics (and their elements) concurrently, writes the
+payloads with bounded concurrency, prints a diff in dry-run mode, and journals the
+topics already handled with their pre-image, so that an interrupted run resumes
+where it stopped and a migration can be rolled back. Each run is recorded in a
+ledger.
+"""
+import difflib
+import importlib
+import json
+import pkgutil
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from copy import deepcopy
+from dataclasses import dataclass, field
+from datetime import datetime
+from pathlib import Path
+from threading import Lock
+from typing import Callable
+
+from ecospheres.api import DatagouvfrAPI
+from ecospheres.cache import TTL, open_cache
+from ecospheres.config import get_page_config
+from ecospheres.rel import iter_rel_concurrent, pool_size
+
+STATE_DIR = Path("migration-state")
+LEDGER = "ledger.jsonl"
+
+
+@dataclass
+class MigrationContext:
+    api: DatagouvfrAPI
+    site: str
+    # migration specific options, e.g. `move`
+    options: dict = field(default_factory=dict)
+
+
+@dataclass
+class Migration:
+    name: str
+    transform: Callable[[dict, MigrationContext], dict | None]
+    # replace the `elements` rel of the topic by the list of its elements
+    elements: bool = False
+
+    @property
+    def description(self) -> str:
+        return (self.transform.__doc__ or "").strip().split("\n")[0]
+
+
+MIGRATIONS: dict[str, Migration] = {}
+
+
+def migration(name: str, elements: bool = False):
+    def register(transform):
+        MIGRATIONS[name] = Migration(name, transform, elements)
+        return transform
+    return register
+
+
+def load_migrations() -> dict[str, Migration]:
+    """Import the modules of `ecospheres.migrations`, registering their migrations"""
+    import ecospheres.migrations as package
+    for module in pkgutil.iter_modules(package.__path__):
+        importlib.import_module(f"{package.__name__}.{module.name}")
+    return MIGRATIONS
+
+
+def get_migration(name: str) -> Migration:
+    if name not in MIGRATIONS:
+        importlib.import_module(f"ecospheres.migrations.{name}")
+    return MIGRATIONS[name]
+
+
+class Journal:
+    """
+    Append-only JSONL journal of the topics handled by a migration
+
+    Each line records a topic, the outcome of its migration (`updated`,
+    `unchanged`, `failed` or `rolled-back`) and, for updates, its pre-image: the
+    fields of the topic as they were before the update, which `rollback` PUTs back.
+    Lines are flushed as they are written, so the journal survives a crash.
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+        self.lock = Lock()
+        self.entries = []
+        if path.exists():
+            with open(path) as f:
+                self.entries = [json.loads(line) for line in f if line.strip()]
+
+    @property
+    def done(self) -> set[str]:
+        """Topics whose last outcome is a success"""
+        last = {entry["topic"]: entry["status"] for entry in self.entries}
+        return {topic for topic, status in last.items() if status in ("updated", "unchanged")}
+
+    def pre_images(self) -> dict[str, dict]:
+        """Entries of the updated topics holding their original state, since their last rollback"""
+        pending = {}
+        for entry in self.entries:
+            if entry["status"] == "updated":
+                pending.setdefault(entry["topic"], entry)
+            elif entry["status"] == "rolled-back":
+                pending.pop(entry["topic"], None)
+        return pending
+
+    def record(self, topic: dict, status: str, pre_image: dict | None = None, error: str | None = None):
+        entry = {
+            "topic": topic["id"],
+            "slug": topic["slug"],
+            "status": status,
+            "at": datetime.now().isoformat(timespec="seconds"),
+        }
+        if pre_image is not None:
+            entry["pre_image"] = pre_image
+        if error:
+            entry["error"] = error
+        with self.lock:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            with open(self.path, "a") as f:
+                f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+            self.entries.append(entry)
+
+
+def read_ledger(state_dir: Path) -> list[dict]:
+    path = state_dir / LEDGER
+    if not path.exists():
+        return []
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def append_ledger(state_dir: Path, entry: dict):
+    state_dir.mkdir(parents=True, exist_ok=True)
+    with open(state_dir / LEDGER, "a") as f:
+        f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+
+
+def payload_diff(topic: dict, payload: dict) -> str:
+    """Unified diff of the fields of the topic changed by the payload"""
+    before = json.dumps({k: topic.get(k) for k in payload}, indent=2, ensure_ascii=False)
+    after = json.dumps(payload, indent=2, ensure_ascii=False)
+    return "\n".join(difflib.unified_diff(
+        before.splitlines(), after.splitlines(), "current", "migrated", lineterm="",
+    ))
+
+
+def pre_image(topic: dict, payload: dict) -> dict:
+    """
+    Fields of the topic overwritten by the payload, in a form that can be PUT back
+
+    Elements are kept as fetched, with their `id`, as a migration sends them: PUT
+    back, they are the original elements rather than new copies of them.
+    """
+    return {k: topic.get(k) for k in payload}
+
+
+def with_elements(topic: dict, api: DatagouvfrAPI) -> dict:
+    return {**topic, "elements": list(iter_rel_concurrent(topic["elements"], api))}
+
+
+def prepare(migration: Migration, context: MigrationContext, topic: dict) -> tuple[dict, dict | None]:
+    if migration.elements:
+        topic = with_elements(topic, context.api)
+    # the transform may modify its argument, keep the topic intact for the diff and pre-image
+    payload = migration.transform(deepcopy(topic), context)
+    if payload and "elements" in payload and not migration.elements:
+        topic = with_elements(topic, context.api)
+    return topic, payload
+
+
+def safely_prepare(migration: Migration, context: MigrationContext,
+                   topic: dict) -> tuple[dict, dict | None, Exception | None]:
+    """`prepare`, returning the error instead of raising it, so that one topic can't abort the run"""
+    try:
+        return *prepare(migration, context, topic), None
+    except Exception as e:
+        return topic, None, e
+
+
+def run_migration(
+    migration: Migration,
+    env: str,
+    site: str = "ecospheres",
+    page: str = "bouquets",
+    slug: str = "",
+    dry_run: bool = False,
+    restart: bool = False,
+    concurrency: int = 8,
+    write_concurrency: int = 4,
+    cache_dir: str = "",
+    options: dict | None = None,
+):
+    config = get_page_config(site, env, page)
+    api = DatagouvfrAPI(
+        config.base_url,
+        # a real run revalidates every cached read, its payloads and pre-images must be current
+        cache=open_cache(cache_dir, ttl=TTL if dry_run else 0),
+        pool_size=pool_size(concurrency, write_concurrency),
+    )
+    context = MigrationContext(api, site, options or {})
+
+    state_dir = STATE_DIR / site / env
+    journal = Journal(state_dir / f"{migration.name}.jsonl")
+
+    topics = api.get_topics(config.universe_query["tag"])
+    topics = [t for t in topics if t["slug"] == slug] if slug else topics
+    done = set() if dry_run or restart else journal.done
+    todo = [t for t in topics if t["id"] not in done]
+    if len(todo) < len(topics):
+        print(f"Resuming: {len(topics) - len(todo)} topics already migrated, see {journal.path}")
+    print(f"Running {migration.name} on {len(todo)} topics ({site} on {env})")
+
+    started = datetime.now().isoformat(timespec="seconds")
+    updated, unchanged, failed = 0, 0, 0
+
+    def write(topic: dict, payload: dict):
+        try:
+            api.put(f"/api/2/topics/{topic['id']}/", json=payload)
+        except Exception as e:
+            journal.record(topic, "failed", pre_image(topic, payload), error=str(e))
+            raise e
+        journal.record(topic, "updated", pre_image(topic, payload))
+
+    with api, \
+         ThreadPoolExecutor(max_workers=concurrency) as fetchers, \
+         ThreadPoolExecutor(max_workers=write_concurrency) as writers:
+        writes = {}
+        for topic, payload, error in fetchers.map(lambda t: safely_prepare(migration, context, t), todo):
+            if error:
+                print(f"⚠ Failed to migrate {topic['slug']}: {error}")
+                failed += 1
+                if not dry_run:
+                    journal.record(topic, "failed", error=str(error))
+            elif payload is None:
+                print(f"Unchanged: {topic['slug']}")
+                unchanged += 1
+                if not dry_run:
+                    journal.record(topic, "unchanged")
+            elif dry_run:
+                print(f"Would update {topic['slug']}:")
+                print(payload_diff(topic, payload))
+                updated += 1
+            else:
+                writes[writers.submit(write, topic, payload)] = topic
+
+        for future in as_completed(writes):
+            topic = writes[future]
+            try:
+                future.result()
+                print(f"Updated: {topic['slug']}")
+                updated += 1
+            except Exception as e:
+                print(f"⚠ Failed to update {topic['slug']}: {e}")
+                failed += 1
+
+    print(f"{'Would update' if dry_run else 'Updated'} {updated}/{len(todo)} topics, "
+          f"{unchanged} unchanged, {failed} failed")
+    if not dry_run:
+        append_ledger(state_dir, {
+            "migration": migration.name,
+            "site": site,
+            "env": env,
+            "page": page,
+            "slug": slug or None,
+            "options": options or {},
+            "started": started,
+            "finished": datetime.now().isoformat(timespec="seconds"),
+            "updated": updated,
+            "unchanged": unchanged,
+            "failed": failed,
+            "complete": not slug and all(t["id"] in journal.done for t in topics),
+        })
+
+
+def rollback_migration(
+    name: str,
+    env: str,
+    site: str = "ecospheres",
+    page: str = "bouquets",
+    slug: str = "",
+    dry_run: bool = False,
+    write_concurrency: int = 4,
+):
+    """PUT back the pre-images journaled by the runs of a migration"""
+    config = get_page_config(site, env, page)
+    api = DatagouvfrAPI(config.base_url)
+
+    state_dir = STATE_DIR / site / env
+    journal = Journal(state_dir / f"{name}.jsonl")
+    entries = [e for e in journal.pre_images().values() if not slug or e["slug"] == slug]
+    print(f"Rolling back {name} on {len(entries)} topics ({site} on {env}), from {journal.path}")
+    if dry_run:
+        for entry in entries:
+            print(f"Would roll back {entry['slug']} ({', '.join(entry['pre_image'])})")
+        return
+
+    started = datetime.now().isoformat(timespec="seconds")
+    rolled_back, failed = 0, 0
+
+    def restore(entry: dict):
+        api.put(f"/api/2/topics/{entry['topic']}/", json=entry["pre_image"])
+        journal.record({"id": entry["topic"], "slug": entry["slug"]}, "rolled-back")
+
+    with ThreadPoolExecutor(max_workers=write_concurrency) as writers:
+        futures = {writers.submit(restore, entry): entry for entry in entries}
+        for future in as_completed(futures):
+            entry = futures[future]
+            try:
+                future.result()
+                print(f"Rolled back: {entry['slug']}")
+                rolled_back += 1
+            except Exception as e:
+                print(f"⚠ Failed to roll back {entry['slug']}: {e}")
+                failed += 1
+
+    print(f"Rolled back {rolled_back}/{len(entries)} topics, {failed} failed")
+    append_ledger(state_dir, {
+        "migration": name,
+        "rollback": True,
+        "site": site,
+        "env": env,
+        "page": page,
+        "slug": slug or None,
+        "started": started,
+        "finished": datetime.now().isoformat(timespec="seconds"),
+        "updated": rolled_back,
+        "unchanged": 0,
+        "failed": failed,
+        "complete": not slug and failed == 0,
+    })
@@ -1,65 +1,75 @@
-import json
-
 from minicli import cli, run
 
-from ecospheres.api import DatagouvfrAPI
-from ecospheres.config import get_page_config
+from ecospheres.api import MISSING_STATUSES
+from ecospheres.migration import MigrationContext, get_migration, migration, run_migration
+from ecospheres.models import Element
+from ecospheres.rel import MAX_WORKERS
 
+NAME = "20250528_1_migrate_to_elements"
 
-@cli
-def migrate_bouquets(slug: str = "", dry_run: bool = False, move: bool = False, env: str = "demo", site: str = "ecospheres", page: str = "bouquets"):
+
+@migration(NAME)
+def migrate_to_elements(bouquet: dict, context: MigrationContext) -> dict | None:
     """
     Migrate bouquets from legacy extra structure to new elements structure in Topics.
-    Should work for all sites, given the correct conf.
     """
-    config = get_page_config(site, env, page)
-    api = DatagouvfrAPI(config.base_url)
-    bouquets = api.get_topics(config.universe_query["tag"])
-    bouquets = [b for b in bouquets if b["slug"] == slug] if slug else bouquets
-    for bouquet in bouquets:
-        print(f"--> Handling {bouquet['slug']}...")
+    site = context.site
+    site_extras = bouquet["extras"].get(site)
+    if not site_extras:
+        print(f"No extras for this site on {bouquet['slug']}, skipping.")
+        return None
 
-        site_extras = bouquet["extras"].get(site)
-        if not site_extras:
-            print("No extras for this site, skipping.")
-            continue
+    factors = site_extras.get("datasets_properties")
+    # a failed check raises rather than dropping the dataset reference; probes run within
+    # a fetcher thread of the migration, bound as its elements prefetch
+    statuses = context.api.dataset_statuses(
+        (f["id"] for f in factors if f["availability"] == "available"), max_workers=MAX_WORKERS
+    )
 
-        elements = []
-        for factor in site_extras.get("datasets_properties"):
-            element = {
-                "title": factor["title"],
-                "description": factor["purpose"],
-                "tags": [],
-                "extras": {
-                    site: {
-                        "uri": factor.get("uri"),
-                        "availability": factor["availability"],
-                    }
+    elements = []
+    for factor in factors:
+        element = Element(
+            title=factor["title"],
+            description=factor["purpose"],
+            extras={
+                site: {
+                    "uri": factor.get("uri"),
+                    "availability": factor["availability"],
                 }
-            }
-            # Add group only if it exists
-            if g := factor.get("group"):
-                element["extras"][site]["group"] = g  # reference to data.gouv.fr dataset
-            if factor["availability"] == "available":
-                r = api._get(f"/api/2/datasets/{factor['id']}")
-                if not r.ok:
-                    print(f"⚠ Dataset {factor['id']} not found ({r.status_code}), skipping.")
-                else:
-                    element["element"] = {"class": "Dataset", "id": factor["id"]}
-            elements.append(element)
+            },
+        )
+        # Add group only if it exists
+        if g := factor.get("group"):
+            element.extras[site]["group"] = g  # reference to data.gouv.fr dataset
+        if factor["availability"] == "available":
+            if (status := statuses[factor["id"]]) in MISSING_STATUSES:
+                print(f"⚠ Dataset {factor['id']} not found ({status}), skipping.")
+            else:
+                element.element = {"class": "Dataset", "id": factor["id"]}
+        elements.append(element.to_payload())
+
+    payload = {
+        "tags": bouquet["tags"],
+        "elements": elements,
+    }
+    if context.options.get("move"):
+        payload["extras"] = {k: v for k, v in bouquet["extras"].items() if k != site}
+    return payload
 
-        payload = {
-            "tags": bouquet["tags"],
-            "elements": elements,
-        }
-        if move:
-            payload["extras"] = {k: v for k, v in bouquet["extras"].items() if k != site}
 
-        if not dry_run:
-            api.put(f"/api/2/topics/{bouquet['id']}/", json=payload)
-        else:
-            print("Would have updated with:")
-            print(json.dumps(payload, indent=2))
+@cli
+def migrate_bouquets(slug: str = "", dry_run: bool = False, move: bool = False, env: str = "demo",
+                     site: str = "ecospheres", page: str = "bouquets", cache_dir: str = "",
+                     restart: bool = False, concurrency: int = 8, write_concurrency: int = 4):
+    """
+    Migrate bouquets from legacy extra structure to new elements structure in Topics.
+    Should work for all sites, given the correct conf.
+    """
+    run_migration(
+        get_migration(NAME), env, site=site, page=page, slug=slug, dry_run=dry_run, restart=restart,
+        concurrency=concurrency, write_concurrency=write_concurrency, cache_dir=cache_dir,
+        options={"move": move},
+    )
 
 
 if __name__ == "__main__":
@@ -1,68 +1,58 @@
-import json
-
 from minicli import cli, run
 
-from ecospheres.api import DatagouvfrAPI
-from ecospheres.config import get_page_config
-from ecospheres.rel import iter_rel
+from ecospheres.migration import MigrationContext, get_migration, migration, run_migration
 
+NAME = "20250912_1_fix_group_migration"
 
-@cli
-def fix_group_migration(slug: str = "", dry_run: bool = False, env: str = "demo", site: str = "ecospheres", page: str = "bouquets"):
+
+@migration(NAME, elements=True)
+def fix_groups(topic: dict, context: MigrationContext) -> dict | None:
     """
-    Fix group values in Topic elements after migration:
+    Fix group values in Topic elements after migration
+
     - Convert group: null -> remove the property (undefined)
     - Convert group: "Sans regroupement" -> remove the property (undefined)
     - Keep valid group names as-is
-
-    Should work for all sites, given the correct conf.
     """
-    config = get_page_config(site, env, page)
-    api = DatagouvfrAPI(config.base_url)
-    topics = api.get_topics(config.universe_query["tag"])
-    topics = [t for t in topics if t["slug"] == slug] if slug else topics
-
-    fixed_count = 0
-    total_topics = len(topics)
+    site = context.site
+    elements_fixed = False
+    updated_elements = []
 
-    for topic in topics:
-        print(f"--> Handling {topic['slug']}...")
+    for element in topic["elements"]:
+        site_extras = element.get("extras", {}).get(site, {})
+        if not site_extras:
+            continue
 
-        elements = list(iter_rel(topic["elements"], api))
-        elements_fixed = False
-        updated_elements = []
+        group_value = site_extras.get("group", False)
 
-        for element in elements:
-            site_extras = element.get("extras", {}).get(site, {})
-            if not site_extras:
-                continue
+        # Check if group needs fixing
+        if group_value is None or group_value == "Sans regroupement":
+            print(f"  Fixing element '{element.get('title', 'Untitled')}': group={repr(group_value)} -> undefined")
+            elements_fixed = True
+            # Remove the group property entirely (equivalent to undefined in JS)
+            del element["extras"][site]["group"]
+        updated_elements.append(element)
 
-            group_value = site_extras.get("group", False)
+    if not elements_fixed:
+        return None
+    return {
+        "tags": topic["tags"],
+        "elements": updated_elements,
+    }
 
-            # Check if group needs fixing
-            if group_value is None or group_value == "Sans regroupement":
-                print(f"  Fixing element '{element.get('title', 'Untitled')}': group={repr(group_value)} -> undefined")
-                elements_fixed = True
-                # Remove the group property entirely (equivalent to undefined in JS)
-                del element["extras"][site]["group"]
-            updated_elements.append(element)
 
-        if elements_fixed:
-            fixed_count += 1
-            payload = {
-                "tags": topic["tags"],
-                "elements": updated_elements,
-            }
-
-            if not dry_run:
-                api.put(f"/api/2/topics/{topic['id']}/", json=payload)
-            else:
-                print("Would have updated with:")
-                print(json.dumps(payload, indent=2))
-        else:
-            print(f"No fixes needed for {topic['id']}")
-
-    print(f"Fixed {fixed_count}/{total_topics} topics")
+@cli
+def fix_group_migration(slug: str = "", dry_run: bool = False, env: str = "demo", site: str = "ecospheres",
+                        page: str = "bouquets", cache_dir: str = "", restart: bool = False,
+                        concurrency: int = 8, write_concurrency: int = 4):
+    """
+    Fix group values in Topic elements after migration.
+    Should work for all sites, given the correct conf.
+    """
+    run_migration(
+        get_migration(NAME), env, site=site, page=page, slug=slug, dry_run=dry_run, restart=restart,
+        concurrency=concurrency, write_concurrency=write_concurrency, cache_dir=cache_dir,
+    )
 
 
 if __name__ == "__main__":
@@ -0,0 +1,196 @@
+"""
+Typed views of the topics, elements and datasets payloads
+
+Each model keeps only the fields the scripts read, in a slotted dataclass, so a
+whole universe held in memory takes a fraction of its raw payloads. `FIELDS` is
+the `X-Fields` mask of these fields, and `from_payload` accepts payloads fetched
+with it or without any mask.
+"""
+from dataclasses import dataclass, field
+from datetime import datetime
+from typing import Any, ClassVar, Mapping, Optional, Sequence
+
+from ecospheres.api import ELEMENT_FIELDS, TOPIC_FIELDS
+
+SCHEMA_FIELDS = "url,name,version"
+
+
+def maybe_get(payload: Mapping | Sequence, *path) -> Optional[Any]:
+    for p in path:
+        if not hasattr(payload, "__getitem__"):
+            return None
+        try:
+            payload = payload[p]
+        except (IndexError, KeyError):
+            return None
+        if not payload:
+            return None
+    return payload  # type: ignore
+
+
+def parse_datetime(value: str | None) -> datetime | None:
+    return datetime.fromisoformat(value) if value else None
+
+
+def schema_label(payload: dict[str, Any]) -> str | None:
+    schema = payload.get("schema")
+    if not schema:
+        return None
+    label = schema.get("url") or schema.get("name")
+    if not label:
+        return None
+    version = schema.get("version")
+    return f"{label} (version {version})" if version else label
+
+
+@dataclass(slots=True)
+class Author:
+    name: str
+    page: str
+
+    FIELDS: ClassVar[str] = "name,page"
+
+    @classmethod
+    def from_payload(cls, payload: dict[str, Any]) -> Optional["Author"]:
+        """Organization, or else owner, of a topic or dataset"""
+        author = payload.get("organization") or payload.get("owner")
+        return cls(author["name"], author["page"]) if author else None
+
+
+@dataclass(slots=True)
+class DatasetResource:
+    id: str
+    title: str
+    type: str
+    format: str | None
+    available: bool | None
+    schema: str | None
+
+    FIELDS: ClassVar[str] = f"id,title,type,format,extras,schema{{{SCHEMA_FIELDS}}}"
+
+    @classmethod
+    def from_payload(cls, payload: dict[str, Any]) -> "DatasetResource":
+        return cls(
+            id=payload["id"],
+            title=payload["title"],
+            type=payload["type"],
+            format=payload.get("format"),
+            # not `maybe_get`, which would turn False into None
+            available=(payload.get("extras") or {}).get("check:available"),
+            schema=schema_label(payload),
+        )
+
+
+@dataclass(slots=True)
+class Dataset:
+    id: str
+    page: str
+    title: str
+    author: Author | None
+    last_modified: datetime | None
+    license: str | None
+    schema: str | None
+    quality_score: float | None
+    resources: list[DatasetResource]
+
+    FIELDS: ClassVar[str] = (
+        f"id,page,title,last_modified,license,quality{{score}},schema{{{SCHEMA_FIELDS}}},"
+        f"organization{{{Author.FIELDS}}},owner{{{Author.FIELDS}}},"
+        f"resources{{{DatasetResource.FIELDS}}}"
+    )
+
+    @classmethod
+    def from_payload(cls, payload: dict[str, Any]) -> "Dataset":
+        return cls(
+            id=payload["id"],
+            page=payload["page"],
+            title=payload["title"],
+            author=Author.from_payload(payload),
+            last_modified=parse_datetime(payload.get("last_modified")),
+            license=payload.get("license"),
+            schema=schema_label(payload),
+            quality_score=(payload.get("quality") or {}).get("score"),
+            resources=[DatasetResource.from_payload(r) for r in payload.get("resources") or []],
+        )
+
+
+@dataclass(slots=True)
+class Element:
+    title: str
+    description: str | None = None
+    tags: list[str] = field(default_factory=list)
+    extras: dict[str, Any] = field(default_factory=dict)
+    # referenced object, e.g. {"class": "Dataset", "id": "..."}
+    element: dict[str, str] | None = None
+    id: str | None = None
+
+    FIELDS: ClassVar[str] = "id,title,description,tags,extras,element{class,id}"
+
+    @classmethod
+    def from_payload(cls, payload: dict[str, Any]) -> "Element":
+        return cls(
+            title=payload["title"],
+            description=payload.get("description"),
+            tags=payload.get("tags") or [],
+            extras=payload.get("extras") or {},
+            element=payload.get("element"),
+            id=payload.get("id"),
+        )
+
+    @property
+    def dataset_id(self) -> str | None:
+        return self.element["id"] if self.element else None
+
+    def site_extras(self, site: str) -> dict[str, Any]:
+        return self.extras.get(site) or {}
+
+    def to_payload(self) -> dict[str, Any]:
+        """Writable fields, as sent when creating or updating a topic"""
+        return {k: getattr(self, k) for k in ELEMENT_FIELDS}
+
+
+@dataclass(slots=True)
+class Topic:
+    id: str
+    slug: str | None = None
+    name: str | None = None
+    description: str | None = None
+    tags: list[str] = field(default_factory=list)
+    extras: dict[str, Any] = field(default_factory=dict)
+    private: bool | None = None
+    spatial: dict[str, Any] | None = None
+    last_modified: datetime | None = None
+    organization: dict[str, Any] | None = None
+    owner: dict[str, Any] | None = None
+    # rel to the elements, e.g. {"href": ".../elements/", "total": 12}
+    elements: dict[str, Any] | None = None
+
+    FIELDS: ClassVar[str] = (
+        "id,slug,name,description,tags,extras,private,spatial,last_modified,elements{href,total},"
+        "organization{id,name,page},owner{id,name,page}"
+    )
+
+    @classmethod
+    def from_payload(cls, payload: dict[str, Any]) -> "Topic":
+        return cls(
+            id=payload["id"],
+            slug=payload.get("slug"),
+            name=payload.get("name"),
+            description=payload.get("description"),
+            tags=payload.get("tags") or [],
+            extras=payload.get("extras") or {},
+            private=payload.get("private"),
+            spatial=payload.get("spatial"),
+            last_modified=parse_datetime(payload.get("last_modified")),
+            organization=payload.get("organization"),
+            owner=payload.get("owner"),
+            elements=payload.get("elements"),
+        )
+
+    @property
+    def author(self) -> Author | None:
+        return Author.from_payload({"organization": self.organization, "owner": self.owner})
+
+    def to_payload(self) -> dict[str, Any]:
+        """Writable fields, as sent when creating or updating a topic (elements aside)"""
+        return {k: getattr(self, k) for k in TOPIC_FIELDS}
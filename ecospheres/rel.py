@@ -2,6 +2,17 @@ from typing import TypedDict
 
 from ecospheres.api import DatagouvfrAPI
 
+MAX_WORKERS = 4
+
+
+def pool_size(iterating: int, others: int = 0) -> int:
+    """
+    Connections needed by `iterating` threads each running `iter_rel_concurrent`,
+    which prefetches pages with up to `MAX_WORKERS` more threads, and `others`
+    threads making one request at a time.
+    """
+    return iterating * (1 + MAX_WORKERS) + others
+
 
 class Rel(TypedDict):
     href: str
@@ -14,3 +25,15 @@ def iter_rel(rel: Rel, api: DatagouvfrAPI):
         current_url = payload["next_page"]
         for d in payload["data"]:
             yield d
+
+
+def iter_rel_concurrent(rel: Rel, api: DatagouvfrAPI, max_workers: int = MAX_WORKERS,
+                        fields: str | None = None):
+    """
+    Same as `iter_rel`, but fetch the pages after the first one concurrently.
+
+    Pages are fetched up to `max_workers` ahead, elements are still yielded in
+    page order. `fields` is the `X-Fields` mask of the elements.
+    """
+    for page in api.iter_pages(rel["href"], fields=fields, prefetch=max_workers):
+        yield from page["data"]
@@ -0,0 +1,58 @@
+"""
+JSON encoding and decoding, with orjson or msgspec when installed
+
+Both are optional and several times faster than the standard library on large
+payloads. `loads` accepts the raw bytes of a response body, `dumps` returns UTF-8
+bytes, compact by default or indented with two spaces.
+"""
+import json
+from typing import Any, BinaryIO, Callable
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgspec
+except ImportError:
+    msgspec = None
+
+
+def json_loads(data: bytes | str) -> Any:
+    return json.loads(data)
+
+
+def json_dumps(obj: Any, indent: bool = False) -> bytes:
+    if indent:
+        return json.dumps(obj, indent=2, ensure_ascii=False).encode()
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode()
+
+
+BACKENDS: dict[str, tuple[Callable[[bytes | str], Any], Callable[..., bytes]]] = {
+    "json": (json_loads, json_dumps),
+}
+
+if orjson is not None:
+    def orjson_dumps(obj: Any, indent: bool = False) -> bytes:
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2 if indent else 0)
+
+    BACKENDS["orjson"] = (orjson.loads, orjson_dumps)
+
+if msgspec is not None:
+    def msgspec_dumps(obj: Any, indent: bool = False) -> bytes:
+        data = msgspec.json.encode(obj)
+        return msgspec.json.format(data, indent=2) if indent else data
+
+    BACKENDS["msgspec"] = (msgspec.json.decode, msgspec_dumps)
+
+BACKEND = next(name for name in ("orjson", "msgspec", "json") if name in BACKENDS)
+loads, dumps = BACKENDS[BACKEND]
+
+
+def dump(obj: Any, f: BinaryIO, indent: bool = False):
+    f.write(dumps(obj, indent=indent))
+
+
+def load(f: BinaryIO) -> Any:
+    return loads(f.read())
@@ -0,0 +1,111 @@
+import gzip
+import hashlib
+import json
+import os
+
+from pathlib import Path
+from typing import Any
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+EXTENSIONS = {"none": ".json", "gzip": ".json.gz", "zstd": ".json.zst"}
+
+
+def compress(data: bytes, compression: str) -> bytes:
+    if compression == "gzip":
+        return gzip.compress(data)
+    if compression == "zstd":
+        return zstandard.ZstdCompressor().compress(data)
+    return data
+
+
+def decompress(data: bytes, compression: str) -> bytes:
+    if compression == "gzip":
+        return gzip.decompress(data)
+    if compression == "zstd":
+        return zstandard.ZstdDecompressor().decompress(data)
+    return data
+
+
+class BackupStore:
+    """
+    Content-addressed store for bouquet backups
+
+    Payloads are serialized canonically, hashed (sha256) and saved once under
+    `objects/`, whatever the number of snapshots referencing them. A snapshot is a
+    small JSON manifest under `snapshots/` mapping each bouquet ID to the hashes of
+    its payload and elements.
+    """
+
+    def __init__(self, root: Path, compression: str = "gzip"):
+        if compression not in EXTENSIONS:
+            raise ValueError(f"Unknown compression '{compression}'")
+        if compression == "zstd" and zstandard is None:
+            raise ValueError("zstd compression requires the zstandard package")
+        self.root = root
+        self.compression = compression
+        self.objects_dir = root / "objects"
+        self.snapshots_dir = root / "snapshots"
+        self.objects_dir.mkdir(parents=True, exist_ok=True)
+        self.snapshots_dir.mkdir(parents=True, exist_ok=True)
+
+    def object_path(self, digest: str, compression: str) -> Path:
+        return self.objects_dir / digest[:2] / f"{digest[2:]}{EXTENSIONS[compression]}"
+
+    def put(self, payload: Any) -> str:
+        data = json.dumps(payload, sort_keys=True, ensure_ascii=False, separators=(",", ":")).encode()
+        digest = hashlib.sha256(data).hexdigest()
+        if self.find(digest):
+            return digest
+        path = self.object_path(digest, self.compression)
+        path.parent.mkdir(exist_ok=True)
+        tmp_path = path.with_name(f".{path.name}.tmp")
+        tmp_path.write_bytes(compress(data, self.compression))
+        os.replace(tmp_path, path)
+        return digest
+
+    def find(self, digest: str) -> tuple[Path, str] | None:
+        """Locate an object, whichever compression it was written with"""
+        for compression in EXTENSIONS:
+            path = self.object_path(digest, compression)
+            if path.exists():
+                return path, compression
+        return None
+
+    def get(self, digest: str) -> Any:
+        if not (found := self.find(digest)):
+            raise KeyError(f"Missing object {digest}")
+        path, compression = found
+        return json.loads(decompress(path.read_bytes(), compression))
+
+    def snapshots(self) -> list[str]:
+        return sorted(p.stem for p in self.snapshots_dir.glob("*.json"))
+
+    def read_snapshot(self, name: str) -> dict:
+        with open(self.snapshots_dir / f"{name}.json") as f:
+            return json.load(f)
+
+    def write_snapshot(self, name: str, manifest: dict):
+        with open(self.snapshots_dir / f"{name}.json", "w") as f:
+            json.dump(manifest, f, indent=2, ensure_ascii=False)
+
+    def gc(self, dry_run: bool = False) -> tuple[int, int]:
+        """Remove objects referenced by no snapshot, return their count and size"""
+        referenced = set()
+        for name in self.snapshots():
+            for entry in self.read_snapshot(name).values():
+                referenced.update((entry["topic"], entry["elements"]))
+
+        count, size = 0, 0
+        for path in self.objects_dir.glob("*/*"):
+            digest = path.parent.name + path.name.split(".")[0]
+            if digest in referenced:
+                continue
+            count += 1
+            size += path.stat().st_size
+            if not dry_run:
+                path.unlink()
+        return count, size
@@ -0,0 +1,168 @@
+"""
+Writers of dataclass rows as CSV, NDJSON, Parquet or Arrow files
+
+Rows are read field by field, without building a dict per row. The columnar
+formats (Parquet, Arrow IPC) are written in record batches as rows come in, with
+a schema derived from the dataclass annotations: `datetime` fields are UTC
+timestamps, `float` fields doubles, so that DuckDB or pandas load them without
+type inference. Both require the optional `pyarrow` package.
+"""
+import csv
+import types
+
+from abc import ABC, abstractmethod
+from dataclasses import fields
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Iterable, Union, get_args, get_origin, get_type_hints
+
+from ecospheres.serialization import dumps
+
+try:
+    import pyarrow
+    import pyarrow.ipc
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+EXTENSIONS = {"csv": ".csv", "ndjson": ".ndjson", "parquet": ".parquet", "arrow": ".arrow"}
+BATCH_SIZE = 1024
+
+
+def fieldnames(class_or_instance) -> list[str]:
+    return [field.name for field in fields(class_or_instance)]
+
+
+def arrow_type(annotation) -> "pyarrow.DataType":
+    # X | None and Optional[X] are nullable X, Arrow columns being nullable anyway
+    if get_origin(annotation) in (Union, types.UnionType):
+        annotation, = (arg for arg in get_args(annotation) if arg is not type(None))
+    if annotation is datetime:
+        return pyarrow.timestamp("us", tz="UTC")
+    return {
+        str: pyarrow.string(),
+        int: pyarrow.int64(),
+        float: pyarrow.float64(),
+        bool: pyarrow.bool_(),
+    }[annotation]
+
+
+def arrow_schema(row_class) -> "pyarrow.Schema":
+    hints = get_type_hints(row_class)
+    return pyarrow.schema([(name, arrow_type(hints[name])) for name in fieldnames(row_class)])
+
+
+class TableWriter(ABC):
+    """A file of rows of a dataclass, see `open_table`"""
+
+    def __init__(self, path: Path, row_class):
+        self.path = path
+        self.columns = fieldnames(row_class)
+
+    def values(self, row) -> list[Any]:
+        return [getattr(row, column) for column in self.columns]
+
+    @abstractmethod
+    def write(self, rows: Iterable):
+        ...
+
+    @abstractmethod
+    def close(self):
+        ...
+
+    def abort(self):
+        """Close the file of a failed export, by default as written so far"""
+        self.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+class CsvWriter(TableWriter):
+    def __init__(self, path: Path, row_class):
+        super().__init__(path, row_class)
+        self.file = open(path, "w")
+        self.writer = csv.writer(self.file)
+        self.writer.writerow(self.columns)
+
+    def write(self, rows: Iterable):
+        self.writer.writerows(map(self.values, rows))
+
+    def close(self):
+        self.file.close()
+
+
+class NdjsonWriter(TableWriter):
+    def __init__(self, path: Path, row_class):
+        super().__init__(path, row_class)
+        self.file = open(path, "wb")
+
+    def line(self, row) -> bytes:
+        return dumps({
+            column: value.isoformat() if isinstance(value, datetime) else value
+            for column, value in zip(self.columns, self.values(row))
+        }) + b"\n"
+
+    def write(self, rows: Iterable):
+        self.file.writelines(map(self.line, rows))
+
+    def close(self):
+        self.file.close()
+
+
+class ArrowWriter(TableWriter):
+    """Parquet or Arrow IPC file, rows being buffered until a batch is complete"""
+
+    def __init__(self, path: Path, row_class, table_format: str):
+        super().__init__(path, row_class)
+        self.schema = arrow_schema(row_class)
+        if table_format == "parquet":
+            self.writer = pyarrow.parquet.ParquetWriter(path, self.schema)
+        else:
+            self.writer = pyarrow.ipc.new_file(str(path), self.schema)
+        self.pending = []
+
+    def write(self, rows: Iterable):
+        self.pending.extend(rows)
+        if len(self.pending) >= BATCH_SIZE:
+            self.flush()
+
+    def flush(self):
+        if not self.pending:
+            return
+        columns = zip(*map(self.values, self.pending))
+        self.writer.write_batch(pyarrow.record_batch(
+            [pyarrow.array(column, type=type_) for column, type_ in zip(columns, self.schema.types)],
+            schema=self.schema,
+        ))
+        self.pending = []
+
+    def close(self):
+        self.flush()
+        self.writer.close()
+
+    def abort(self):
+        """Remove the file rather than leave a valid-looking partial table"""
+        self.pending = []
+        self.writer.close()
+        self.path.unlink(missing_ok=True)
+
+
+def open_table(path: Path, row_class, table_format: str = "csv") -> TableWriter:
+    """Writer of the rows of `row_class` to `path` (without extension) in the given format"""
+    if table_format not in EXTENSIONS:
+        raise ValueError(f"Unknown format '{table_format}'")
+    if table_format in ("parquet", "arrow") and pyarrow is None:
+        raise ValueError(f"{table_format} format requires the pyarrow package")
+    path = path.with_suffix(EXTENSIONS[table_format])
+    if table_format == "csv":
+        return CsvWriter(path, row_class)
+    if table_format == "ndjson":
+        return NdjsonWriter(path, row_class)
+    return ArrowWriter(path, row_class, table_format)
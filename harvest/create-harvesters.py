@@ -1,32 +1,89 @@
 import argparse
 import json
 import requests
+import sys
+import threading
 import time
 import yaml
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dataclasses import dataclass, field
 from datetime import datetime
+from requests.adapters import HTTPAdapter
+from urllib.parse import urlsplit
+
+from sources import fetch_sources
+
+
+print_lock = threading.Lock()
+log_context = threading.local()
+
+
+def log(*args):
+    """Print atomically, prefixed with the endpoint handled by the current thread"""
+    prefix = getattr(log_context, 'endpoint', None)
+    with print_lock:
+        if prefix:
+            print(f"[{prefix}]", *args)
+        else:
+            print(*args)
+
+
+class RateLimiter:
+    """Token bucket: allows `burst` calls at once, then one call every `interval` seconds"""
+
+    def __init__(self, interval, burst=1):
+        self.interval = interval
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                if self.interval > 0:
+                    self.tokens = min(self.burst, self.tokens + (now - self.updated) / self.interval)
+                else:
+                    self.tokens = self.burst
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) * self.interval
+            time.sleep(wait)
 
 
 class ApiHelper:
 
-    def __init__(self, base_url, token, dry_run=False):
+    def __init__(self, base_url, token, dry_run=False, pool_size=10):
         self.base_url = base_url
         self.token = token
         self.dry_run = dry_run
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
 
     def get_org_id_from_slug(self, slug):
         url = f"{self.base_url}/api/1/organizations/{slug}/"
         headers = {'X-Fields': 'id'}
-        r = requests.get(url, headers=headers)
+        r = self.session.get(url, headers=headers)
         if r.status_code == 404:
             return None
         r.raise_for_status()
         return r.json().get('id')
 
     def get_org_harvesters(self, ident):
-        url = f"{self.base_url}/api/1/harvest/sources/?owner={ident}"
-        r = requests.get(url)
-        r.raise_for_status()
-        return r.json().get('data', [])
+        url = f"{self.base_url}/api/1/harvest/sources/?owner={ident}&page_size=100"
+        harvesters = []
+        while url:
+            r = self.session.get(url)
+            r.raise_for_status()
+            payload = r.json()
+            harvesters.extend(payload.get('data', []))
+            url = payload.get('next_page')
+        return harvesters
 
     def create_org(self, name):
         url = f"{self.base_url}/api/1/organizations/"
@@ -36,11 +93,11 @@ class ApiHelper:
             "description": "Ecospheres test org",
         }
         if not self.dry_run:
-            r = requests.post(url, headers=headers, data=json.dumps(data))
+            r = self.session.post(url, headers=headers, data=json.dumps(data))
             r.raise_for_status()
             return r.json()
         else:
-            print('Would create organization:', json.dumps(data, indent=2))
+            log('Would create organization:', json.dumps(data, indent=2))
             return None
 
 
@@ -66,34 +123,38 @@ class ApiHelper:
             }
 
         if not self.dry_run:
-            r = requests.post(url, data=json.dumps(data), headers=headers)
+            r = self.session.post(url, data=json.dumps(data), headers=headers)
             r.raise_for_status()
             return r.json()
         else:
-            print(f"Would create harvester:", json.dumps(data, indent=2, ensure_ascii=False))
+            log(f"Would create harvester:", json.dumps(data, indent=2, ensure_ascii=False))
             return None
 
 
-    def update_harvester(self, ident, name, target, prefix=None):
+    def update_harvester(self, ident, name, target, prefix=None, update_config=None):
+        """Update name and url, and the config if there is a prefix or `update_config` is set
+
+        With `update_config` and no prefix, the prefix of the harvester is cleared.
+        """
         url = f"{self.base_url}/api/1/harvest/source/{ident}"
         headers = {'Content-Type': 'application/json', 'X-API-KEY': self.token}
         data = {
             'name': name,
             'url': target
         }
-        if prefix:
+        if prefix or update_config:
             data['config'] = {
                 'extra_configs': [
                     {'key': 'remote_url_prefix', 'value': prefix}
-                ]
+                ] if prefix else []
             }
 
         if not self.dry_run:
-            r = requests.put(url, data=json.dumps(data), headers=headers)
+            r = self.session.put(url, data=json.dumps(data), headers=headers)
             r.raise_for_status()
             return r.json()
         else:
-            print(f"Would update harvester:", json.dumps(data, indent=2, ensure_ascii=False))
+            log(f"Would update harvester:", json.dumps(data, indent=2, ensure_ascii=False))
             return None
 
 
@@ -103,12 +164,12 @@ class ApiHelper:
         data = schedule
 
         if not self.dry_run:
-            r = requests.post(url, data=data, headers=headers)
+            r = self.session.post(url, data=data, headers=headers)
             r.raise_for_status()
-            print(f"Updated harvester schedule for '{name}': {schedule}")
+            log(f"Updated harvester schedule: {schedule}")
             return r.json()
         else:
-            print(f"Would update harvester schedule:", data)
+            log(f"Would update harvester schedule:", data)
             return None
 
 
@@ -120,14 +181,14 @@ class ApiHelper:
                 'X-API-KEY': self.token,
                 'X-Fields': 'validation{state}',
             }
-            r = requests.get(url, headers=headers)
+            r = self.session.get(url, headers=headers)
             r.raise_for_status()
             validated = r.json().get("validation", {}).get("state") == "accepted"
             if validated:
-                print("Harvester is already validated, nothing to do.")
+                log("Harvester is already validated, nothing to do.")
                 return True
         else:
-            print("Would check harvester state, then validate if needed.")
+            log("Would check harvester state, then validate if needed.")
             return None
 
         url = f"{self.base_url}/api/1/harvest/source/{ident}/validate"
@@ -138,16 +199,277 @@ class ApiHelper:
         }
         data = {'state': 'accepted'}
         if not self.dry_run:
-            r = requests.post(url, data=json.dumps(data), headers=headers)
+            r = self.session.post(url, data=json.dumps(data), headers=headers)
             r.raise_for_status()
             validated = r.json().get("validation", {}).get("state") == "accepted"
-            print(f"Harvester validation {'succeeded' if validated else 'failed'}")
+            log(f"Harvester validation {'succeeded' if validated else 'failed'}")
             return validated
         else:
-            print('Would validate harvester:', json.dumps(data, indent=2))
+            log('Would validate harvester:', json.dumps(data, indent=2))
             return True
 
 
+class HarvestState:
+    """
+    Organizations and harvest sources of all the endpoints, fetched up front
+
+    Each organization and its sources are fetched once, however many endpoints
+    share it, so that matching endpoints are only dictionary lookups.
+    """
+
+    def __init__(self, api, endpoints, workers):
+        self.org_ids, sources = fetch_sources(api, endpoints, workers)
+        self.sources = {}
+        self.sources_by_name = {}
+        for owner, harvesters in sources.items():
+            for h in harvesters:
+                self.sources[(owner, h['url'])] = h
+                self.sources_by_name[(owner, h['name'])] = h
+        print(f"Fetched {len(sources)} organizations and {len(self.sources)} harvesters "
+              f"for {len(endpoints)} endpoints")
+
+    def missing_orgs(self):
+        return [slug for slug, org_id in self.org_ids.items() if org_id is None]
+
+    def create_missing_orgs(self, api, args):
+        """Create (or report) missing organizations, return the slugs of the ones to skip"""
+        skipped = set()
+        for slug, org_id in self.org_ids.items():
+            if org_id is not None:
+                continue
+            print(f"Organization '{slug}' is missing")
+            if args.create_orgs:
+                o = api.create_org(slug)
+                self.org_ids[slug] = o.get('id') if o else None
+                if self.org_ids[slug]:
+                    url = f"{api.base_url}/fr/admin/organization/{self.org_ids[slug]}"
+                    print(f"Created organization: {url}")
+            else:
+                skipped.add(slug)
+        return skipped
+
+    def resolve(self, endpoint):
+        org_id = self.org_ids.get(endpoint['org'])
+        return org_id, self.sources.get((org_id, endpoint['url']))
+
+    def resolve_drifted(self, endpoint):
+        """Same as `resolve`, falling back on the harvester name to detect url changes"""
+        org_id, harvester = self.resolve(endpoint)
+        return org_id, harvester or self.sources_by_name.get((org_id, endpoint['name']))
+
+
+def get_prefix(harvester):
+    extra_configs = (harvester.get('config') or {}).get('extra_configs') or []
+    return next((c['value'] for c in extra_configs if c['key'] == 'remote_url_prefix'), None)
+
+
+def normalize_schedule(schedule):
+    return ' '.join(schedule.split()) if schedule else None
+
+
+def parse_window(window):
+    """'22:00-06:00' -> (start minute of the day, length in minutes)"""
+    start, end = (int(h) * 60 + int(m) for h, m in (t.split(':') for t in window.split('-')))
+    return start, (end - start) % (24 * 60) or 24 * 60
+
+
+def spread_schedules(endpoints, window, max_concurrency, max_per_host, durations, default_duration):
+    """
+    Assign a daily cron slot to each endpoint, within `window`
+
+    Longest harvests are placed first, each at the earliest minute where it keeps the
+    number of simultaneous harvests under `max_concurrency` overall and under
+    `max_per_host` for its CSW host. When the window is too short for that, the
+    start with the lowest peak load is used instead.
+    Returns {url: (schedule, duration)}.
+    """
+    window_start, window_length = parse_window(window)
+    duration_of = {e['url']: max(1, round(durations.get(e['url'], default_duration))) for e in endpoints}
+    horizon = window_length + max(duration_of.values(), default=0)
+    load = [0] * horizon
+    host_load = {}
+    assignment = {}
+
+    for endpoint in sorted(endpoints, key=lambda e: -duration_of[e['url']]):
+        duration = duration_of[endpoint['url']]
+        host = host_load.setdefault(urlsplit(endpoint['url']).hostname, [0] * horizon)
+
+        best_start, best_peak = 0, None
+        for start in range(window_length):
+            span = range(start, start + duration)
+            peak = max(max(load[t] - max_concurrency, host[t] - max_per_host) for t in span) + 1
+            if peak <= 0:
+                best_start = start
+                break
+            if best_peak is None or peak < best_peak:
+                best_start, best_peak = start, peak
+        else:
+            log_context.endpoint = endpoint['name']
+            log(f"No free slot in window, scheduled with {best_peak} harvest(s) over the limits")
+            log_context.endpoint = None
+
+        for t in range(best_start, best_start + duration):
+            load[t] += 1
+            host[t] += 1
+        minute = (window_start + best_start) % (24 * 60)
+        assignment[endpoint['url']] = (f"{minute % 60} {minute // 60} * * *", duration)
+
+    print(f"Spread {len(endpoints)} schedules over {window}, peak concurrency {max(load, default=0)}")
+    return assignment
+
+
+@dataclass
+class EndpointPlan:
+    endpoint: dict
+    org_id: str | None
+    harvester_id: str | None
+    create: bool = False
+    updates: dict = field(default_factory=dict)  # field -> (current, desired)
+    schedule: str | None = None
+    validate: bool = False
+
+    @property
+    def changed(self):
+        return self.create or bool(self.updates) or bool(self.schedule) or self.validate
+
+
+def compute_plan(state, endpoints, args, skipped_orgs):
+    """Diff the endpoints config against the current state of the harvesters"""
+    plans = []
+    for endpoint in endpoints:
+        if endpoint['org'] in skipped_orgs:
+            continue
+        org_id, harvester = state.resolve_drifted(endpoint)
+        plan = EndpointPlan(endpoint, org_id, harvester.get('id') if harvester else None)
+        desired_schedule = normalize_schedule(endpoint.get('schedule'))
+
+        if not harvester:
+            plan.create = True
+            plan.schedule = desired_schedule
+            plan.validate = args.validate_harvester
+        else:
+            current = {
+                'name': harvester['name'],
+                'url': harvester['url'],
+                'prefix': get_prefix(harvester),
+            }
+            desired = {
+                'name': endpoint['name'],
+                'url': endpoint['url'],
+                'prefix': endpoint.get('prefix'),
+            }
+            plan.updates = {k: (current[k], v) for k, v in desired.items() if current[k] != v}
+            if desired_schedule and normalize_schedule(harvester.get('schedule')) != desired_schedule:
+                plan.schedule = desired_schedule
+            validation_state = (harvester.get('validation') or {}).get('state')
+            plan.validate = args.validate_harvester and validation_state != 'accepted'
+        plans.append(plan)
+    return plans
+
+
+def print_plan(plans, new_orgs):
+    for slug in new_orgs:
+        print(f"+ create organization {slug}")
+    for plan in plans:
+        if not plan.changed:
+            continue
+        name = plan.endpoint['name']
+        if plan.create:
+            print(f"+ [{name}] create harvester for {plan.endpoint['url']}")
+        for k, (current, desired) in plan.updates.items():
+            print(f"~ [{name}] {k}: {current!r} -> {desired!r}")
+        if plan.schedule:
+            print(f"~ [{name}] schedule: {plan.schedule!r}")
+        if plan.validate:
+            print(f"! [{name}] validate")
+    print(f"Plan: {len(new_orgs)} organizations and {sum(p.create for p in plans)} harvesters to create, "
+          f"{sum(bool(p.updates) for p in plans)} to update, "
+          f"{sum(bool(p.schedule) for p in plans)} to reschedule, "
+          f"{sum(p.validate for p in plans)} to validate, "
+          f"{sum(not p.changed for p in plans)} unchanged.")
+
+
+def apply_plan(api, backend, plan, creation_limiter):
+    endpoint = plan.endpoint
+    log_context.endpoint = endpoint['name']
+    harvester_id = plan.harvester_id
+
+    if plan.create:
+        if not api.dry_run:
+            creation_limiter.acquire()
+        h = api.create_harvester(endpoint['name'], backend, endpoint['url'], plan.org_id,
+                                 prefix=endpoint.get('prefix'))
+        harvester_id = h.get('id') if h else None
+        if harvester_id:
+            log(f"Created harvester: {api.base_url}/fr/admin/harvester/{harvester_id}")
+    elif plan.updates:
+        # a prefix dropped from the config is cleared, otherwise the plan would never converge
+        api.update_harvester(harvester_id, endpoint['name'], endpoint['url'],
+                             prefix=endpoint.get('prefix'), update_config='prefix' in plan.updates)
+        log(f"Updated harvester: {', '.join(plan.updates)}")
+
+    if plan.schedule:
+        api.update_harvester_schedule(harvester_id, plan.schedule)
+
+    if plan.validate:
+        api.validate_harvester(harvester_id)
+
+
+def process_endpoint(api, args, backend, endpoint, resolved, creation_limiter):
+    name = endpoint['name']
+    target = endpoint['url']
+    schedule = endpoint.get('schedule')
+    prefix = endpoint.get('prefix')
+    org_id, harvester = resolved
+    log_context.endpoint = name
+
+    log(f"Processing endpoint at {str(datetime.now())}")
+
+    harvester_id = harvester.get('id') if harvester else None
+    if harvester:
+        url = f"{api.base_url}/fr/admin/harvester/{harvester_id}"
+        if args.update_harvesters:
+            api.update_harvester(harvester_id, name, target, prefix=prefix)
+            log(f"Updated harvester: {url}")
+        else:
+            log(f"Harvester already exists (skipping): {url}")
+    else:
+        if not api.dry_run:
+            creation_limiter.acquire()
+        h = api.create_harvester(name, backend, target, org_id, prefix=prefix)
+        if h:
+            harvester_id = h.get("id")
+            if harvester_id:
+                url = f"{api.base_url}/fr/admin/harvester/{harvester_id}"
+                log(f"Created harvester: {url}")
+
+    if args.validate_harvester:
+        api.validate_harvester(harvester_id)
+
+    if schedule and args.update_schedules:
+        api.update_harvester_schedule(harvester_id, schedule)
+
+
+def run_jobs(workers, jobs):
+    """
+    Run the (endpoint, func, *args) jobs in parallel, return the number of failed ones
+
+    Any error of a job, not only an API one, is reported with its endpoint.
+    """
+    failed = 0
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(func, *args): endpoint for endpoint, func, *args in jobs}
+        for future in as_completed(futures):
+            try:
+                future.result()
+            except Exception as e:
+                failed += 1
+                error = e if isinstance(e, requests.exceptions.RequestException) else repr(e)
+                with print_lock:
+                    print(f"[{futures[future]['name']}] Failed: {error}")
+    return failed
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument('harvests', nargs='+', type=argparse.FileType('r'), metavar='config',
@@ -162,6 +484,29 @@ if __name__ == "__main__":
                         help='validate harvester right away (triggers harvesting)')
     parser.add_argument('-n', '--dry-run', action='store_true', default=False,
                         help='perform a trial run without creating harvesters')
+    parser.add_argument('--plan', action='store_true', default=False,
+                        help='only show the changes needed to match the config')
+    parser.add_argument('--apply', action='store_true', default=False,
+                        help='apply the changes needed to match the config, and only those')
+    parser.add_argument('--spread-schedules', action='store_true', default=False,
+                        help='compute the schedules instead of using the config ones '
+                             '(applied with -s or --apply)')
+    parser.add_argument('--window', default='00:00-06:00',
+                        help='time window for the computed schedules (default: 00:00-06:00)')
+    parser.add_argument('--max-concurrency', type=int, default=4,
+                        help='maximum number of simultaneous harvests (default: 4)')
+    parser.add_argument('--max-per-host', type=int, default=2,
+                        help='maximum number of simultaneous harvests per CSW host (default: 2)')
+    parser.add_argument('--durations', type=argparse.FileType('r'),
+                        help='yaml file of harvest durations in minutes by url')
+    parser.add_argument('--default-duration', type=float, default=15,
+                        help='estimated harvest duration in minutes when unknown (default: 15)')
+    parser.add_argument('-w', '--workers', type=int, default=8,
+                        help='number of endpoints processed in parallel (default: 8)')
+    parser.add_argument('--create-interval', type=float, default=60,
+                        help='minimum delay in seconds between two harvester creations (default: 60)')
+    parser.add_argument('--create-burst', type=int, default=1,
+                        help='number of harvesters that can be created without delay (default: 1)')
 
     args = parser.parse_args()
 
@@ -171,65 +516,56 @@ if __name__ == "__main__":
 
     api_url = conf['api']['url']
     token = conf['api']['token']
-    api = ApiHelper(api_url, token, dry_run=args.dry_run)
+    api = ApiHelper(api_url, token, dry_run=args.dry_run, pool_size=args.workers)
 
     backend = conf['harvests']['backend']
+    creation_limiter = RateLimiter(args.create_interval, burst=args.create_burst)
 
     if args.dry_run:
         print("*** DRY RUN ***")
 
-    for endpoint in conf['harvests']['endpoints']:
-        name = endpoint['name']
-        target = endpoint['url']
-        org_slug = endpoint['org']
-        schedule = endpoint.get('schedule')
-        prefix = endpoint.get('prefix')
-
-        print(f"Processing endpoint {name} at {str(datetime.now())}")
-
-        org_id = api.get_org_id_from_slug(org_slug)
-        org_exists = org_id is not None
-        if not org_exists:
-            print(f"Organization '{org_slug}' for '{name}' is missing")
-            if args.create_orgs:
-                o = api.create_org(org_slug)
-                org_id = o.get('id')
-                if org_id:
-                    url = f"{api_url}/fr/admin/organization/{org_id}"
-                    print(f"Created organization for '{name}': {url}")
-            else:
-                print(f"(skipping endpoint)")
+    endpoints = conf['harvests']['endpoints']
+
+    if args.spread_schedules:
+        durations = yaml.safe_load(args.durations) if args.durations else {}
+        assignment = spread_schedules(endpoints, args.window, args.max_concurrency,
+                                      args.max_per_host, durations, args.default_duration)
+        print(yaml.safe_dump(
+            [{'name': e['name'], 'url': e['url'], 'schedule': assignment[e['url']][0],
+              'duration': assignment[e['url']][1]} for e in endpoints],
+            allow_unicode=True, sort_keys=False,
+        ))
+        for endpoint in endpoints:
+            endpoint['schedule'] = assignment[endpoint['url']][0]
+
+    state = HarvestState(api, endpoints, args.workers)
+
+    failed = 0
+    if args.plan or args.apply:
+        # missing organizations are part of the plan, only created when applying it
+        new_orgs = state.missing_orgs() if args.create_orgs else []
+        skipped_orgs = set() if args.create_orgs else set(state.missing_orgs())
+        plans = compute_plan(state, endpoints, args, skipped_orgs)
+        print_plan(plans, new_orgs)
+        if args.apply:
+            state.create_missing_orgs(api, args)
+            for plan in plans:
+                plan.org_id = state.org_ids.get(plan.endpoint['org'])
+            failed = run_jobs(args.workers, [
+                (plan.endpoint, apply_plan, api, backend, plan, creation_limiter)
+                for plan in plans if plan.changed
+            ])
+    else:
+        skipped_orgs = state.create_missing_orgs(api, args)
+        jobs = []
+        for endpoint in endpoints:
+            if endpoint['org'] in skipped_orgs:
+                print(f"[{endpoint['name']}] Organization '{endpoint['org']}' is missing (skipping endpoint)")
                 continue
+            jobs.append((endpoint, process_endpoint,
+                         api, args, backend, endpoint, state.resolve(endpoint), creation_limiter))
+        failed = run_jobs(args.workers, jobs)
 
-        harvesters = api.get_org_harvesters(org_id) if org_exists else []
-        harvester_id = None
-        harvester_exists = False
-        for h in harvesters:
-            if h['url'] == target:
-                harvester_exists = True
-                harvester_id = h.get('id')
-                url = f"{api_url}/fr/admin/harvester/{harvester_id}"
-                break
-
-        if harvester_exists:
-            if args.update_harvesters:
-                api.update_harvester(harvester_id, name, target, prefix=prefix)
-                print(f"Updated harvester for '{name}': {url}")
-            else:
-                print(f"Harvester for '{name}' already exists (skipping): {url}")
-        else:
-            h = api.create_harvester(name, backend, target, org_id, prefix=prefix)
-            if h:
-                harvester_id = h.get("id")
-                if harvester_id:
-                    url = f"{api_url}/fr/admin/harvester/{harvester_id}"
-                    print(f"Created harvester for '{name}': {url}")
-
-        if args.validate_harvester:
-            validated = api.validate_harvester(harvester_id)
-
-        if schedule and args.update_schedules:
-            api.update_harvester_schedule(harvester_id, schedule)
-
-        if not harvester_exists and not api.dry_run:
-            time.sleep(60)
+    if failed:
+        print(f"{failed} endpoint(s) failed")
+        sys.exit(1)
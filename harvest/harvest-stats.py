@@ -0,0 +1,242 @@
+import argparse
+import math
+import requests
+import sqlite3
+import sys
+import yaml
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from pathlib import Path
+from requests.adapters import HTTPAdapter
+
+from sources import fetch_sources
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS sources (
+    id TEXT PRIMARY KEY,
+    name TEXT NOT NULL,
+    url TEXT NOT NULL,
+    org TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    source_id TEXT NOT NULL REFERENCES sources(id),
+    created TEXT,
+    started TEXT,
+    ended TEXT,
+    status TEXT,
+    errors INTEGER NOT NULL,
+    items INTEGER NOT NULL,
+    items_failed INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS jobs_source ON jobs(source_id);
+"""
+
+# only the job fields used for the statistics, items can be numerous
+JOBS_FIELDS = 'data{id,created,started,ended,status,errors{message},items{status}},next_page'
+
+FINISHED_STATUSES = ('done', 'done-errors', 'failed')
+
+
+class StatsApi:
+
+    def __init__(self, base_url, pool_size=10):
+        self.base_url = base_url
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def get(self, url, headers=None):
+        r = self.session.get(url if '://' in url else f"{self.base_url}{url}", headers=headers)
+        r.raise_for_status()
+        return r.json()
+
+    def get_org_id_from_slug(self, slug):
+        try:
+            return self.get(f"/api/1/organizations/{slug}/", headers={'X-Fields': 'id'}).get('id')
+        except requests.exceptions.HTTPError as e:
+            if e.response.status_code == 404:
+                return None
+            raise e
+
+    def get_org_harvesters(self, ident):
+        url = f"/api/1/harvest/sources/?owner={ident}&page_size=100"
+        harvesters = []
+        while url:
+            payload = self.get(url, headers={'X-Fields': 'data{id,name,url},next_page'})
+            harvesters.extend(payload['data'])
+            url = payload['next_page']
+        return harvesters
+
+    def iter_jobs(self, ident, page_size=20):
+        url = f"/api/1/harvest/source/{ident}/jobs/?page_size={page_size}"
+        while url:
+            payload = self.get(url, headers={'X-Fields': JOBS_FIELDS})
+            yield payload['data']
+            url = payload['next_page']
+
+
+def job_row(source_id, job):
+    items = job.get('items') or []
+    return (
+        job['id'], source_id, job.get('created'), job.get('started'), job.get('ended'),
+        job.get('status'), len(job.get('errors') or []),
+        len(items), sum(1 for i in items if i.get('status') == 'failed'),
+    )
+
+
+def collect_source(api, db_path, source, max_jobs):
+    """Fetch the jobs of a source, newest first, until reaching already known ones"""
+    db = sqlite3.connect(db_path)
+    known = {row[0] for row in db.execute("SELECT id FROM jobs WHERE source_id = ?", (source['id'],))}
+    rows = []
+    for jobs in api.iter_jobs(source['id']):
+        # unfinished jobs are fetched again on the next run
+        new = [j for j in jobs if j['id'] not in known and j.get('status') in FINISHED_STATUSES]
+        rows.extend(job_row(source['id'], j) for j in new)
+        if len(rows) >= max_jobs or any(j['id'] in known for j in jobs):
+            break
+    with db:
+        db.executemany("INSERT OR REPLACE INTO jobs VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", rows[:max_jobs])
+    db.close()
+    return len(rows[:max_jobs])
+
+
+def collect(args):
+    conf = {}
+    for c in args.harvests:
+        conf.update(yaml.safe_load(c))
+    endpoints = conf['harvests']['endpoints']
+    api = StatsApi(conf['api']['url'], pool_size=args.workers)
+
+    db = sqlite3.connect(args.db)
+    db.executescript(SCHEMA)
+
+    org_ids, harvesters = fetch_sources(api, endpoints, args.workers)
+    sources = {(owner, h['url']): h for owner, hs in harvesters.items() for h in hs}
+
+    matched = []
+    for endpoint in endpoints:
+        source = sources.get((org_ids.get(endpoint['org']), endpoint['url']))
+        if not source:
+            print(f"[{endpoint['name']}] No harvester found (skipping)")
+            continue
+        matched.append(source)
+        db.execute("INSERT OR REPLACE INTO sources VALUES (?, ?, ?, ?)",
+                   (source['id'], endpoint['name'], endpoint['url'], endpoint['org']))
+    db.commit()
+    db.close()
+
+    with ThreadPoolExecutor(max_workers=args.workers) as executor:
+        counts = executor.map(lambda s: collect_source(api, args.db, s, args.max_jobs), matched)
+        total = sum(counts)
+    print(f"Collected {total} new jobs for {len(matched)} harvesters in {args.db}")
+
+
+def percentile(values, q):
+    """Nearest-rank percentile of a non-empty list"""
+    values = sorted(values)
+    return values[max(0, math.ceil(q / 100 * len(values)) - 1)]
+
+
+def duration(started, ended):
+    return (datetime.fromisoformat(ended) - datetime.fromisoformat(started)).total_seconds()
+
+
+def throughput(items, seconds):
+    return f"{items / seconds:.2f}" if seconds else 'n/a'
+
+
+def load_stats(db_path):
+    """Per source statistics, from the finished jobs"""
+    if not Path(db_path).exists():
+        sys.exit(f"No statistics database {db_path}, run collect first")
+    db = sqlite3.connect(db_path)
+    jobs = {}
+    query = """
+        SELECT s.id, s.name, s.url, j.started, j.ended, j.status, j.errors, j.items, j.items_failed
+        FROM jobs j JOIN sources s ON s.id = j.source_id
+    """
+    for source_id, name, url, started, ended, status, errors, items, items_failed in db.execute(query):
+        stats = jobs.setdefault(source_id, {
+            'name': name, 'url': url, 'durations': [], 'items': 0, 'seconds': 0, 'timed_items': 0,
+            'jobs': 0, 'failed_jobs': 0, 'items_failed': 0,
+        })
+        stats['jobs'] += 1
+        stats['failed_jobs'] += status != 'done' or errors > 0
+        stats['items_failed'] += items_failed
+        if started and ended:
+            seconds = duration(started, ended)
+            stats['durations'].append(seconds)
+            stats['items'] += items
+            # jobs lasting less than the timestamps resolution have no rate
+            if seconds > 0:
+                stats['timed_items'] += items
+                stats['seconds'] += seconds
+    db.close()
+    return [s for s in jobs.values() if s['durations']]
+
+
+def report(args):
+    stats = load_stats(args.db)
+    if not stats:
+        print(f"No finished jobs in {args.db}")
+        return
+
+    all_durations = [d for s in stats for d in s['durations']]
+    jobs = sum(s['jobs'] for s in stats)
+    items = sum(s['items'] for s in stats)
+    print(f"{len(stats)} harvesters, {jobs} jobs, {items} items")
+    print(f"Duration p50 {percentile(all_durations, 50) / 60:.1f} min, "
+          f"p95 {percentile(all_durations, 95) / 60:.1f} min")
+    print(f"Throughput {throughput(sum(s['timed_items'] for s in stats), sum(s['seconds'] for s in stats))} items/s")
+    print(f"Jobs with errors {sum(s['failed_jobs'] for s in stats) / jobs:.1%}, "
+          f"failed items {sum(s['items_failed'] for s in stats) / max(items, 1):.1%}")
+
+    print("\nSlowest harvesters (by p95 duration):")
+    print(f"{'p50 min':>8} {'p95 min':>8} {'items/s':>8} {'errors':>7}  name")
+    for s in sorted(stats, key=lambda s: -percentile(s['durations'], 95))[:args.top]:
+        print(f"{percentile(s['durations'], 50) / 60:8.1f} {percentile(s['durations'], 95) / 60:8.1f} "
+              f"{throughput(s['timed_items'], s['seconds']):>8} {s['failed_jobs'] / s['jobs']:7.1%}  {s['name']}")
+
+
+def durations(args):
+    stats = load_stats(args.db)
+    data = {s['url']: round(percentile(s['durations'], args.quantile) / 60, 1) for s in stats}
+    yaml.safe_dump(data, args.output, sort_keys=True)
+    print(f"Wrote {len(data)} durations (p{args.quantile}, minutes) to {args.output.name}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='harvest jobs statistics')
+    parser.add_argument('--db', default='harvest-stats.sqlite',
+                        help='statistics database (default: harvest-stats.sqlite)')
+    subparsers = parser.add_subparsers(required=True)
+
+    collect_parser = subparsers.add_parser('collect', help='fetch the jobs history of the harvesters')
+    collect_parser.add_argument('harvests', nargs='+', type=argparse.FileType('r'), metavar='config',
+                                help='harvesters yaml config file(s)')
+    collect_parser.add_argument('-w', '--workers', type=int, default=8,
+                                help='number of harvesters processed in parallel (default: 8)')
+    collect_parser.add_argument('--max-jobs', type=int, default=100,
+                                help='maximum number of new jobs fetched per harvester (default: 100)')
+    collect_parser.set_defaults(func=collect)
+
+    report_parser = subparsers.add_parser('report', help='print duration, throughput and error statistics')
+    report_parser.add_argument('--top', type=int, default=10,
+                               help='number of slowest harvesters listed (default: 10)')
+    report_parser.set_defaults(func=report)
+
+    durations_parser = subparsers.add_parser(
+        'durations', help='write the harvest durations by url, for create-harvesters.py --durations'
+    )
+    durations_parser.add_argument('-o', '--output', type=argparse.FileType('w'), default='durations.yaml',
+                                  help='output file (default: durations.yaml)')
+    durations_parser.add_argument('-q', '--quantile', type=int, default=95,
+                                  help='duration percentile used (default: 95)')
+    durations_parser.set_defaults(func=durations)
+
+    args = parser.parse_args()
+    args.func(args)
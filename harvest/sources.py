@@ -0,0 +1,22 @@
+"""
+Organizations and harvest sources of the endpoints of a harvests config
+
+Shared by `create-harvesters.py` and `harvest-stats.py`, whose API helpers both
+provide `get_org_id_from_slug` and `get_org_harvesters`.
+"""
+from concurrent.futures import ThreadPoolExecutor
+
+
+def fetch_sources(api, endpoints, workers):
+    """
+    Organization ids by slug (None when missing) and harvest sources by organization id
+
+    Each organization and its sources are fetched once, however many endpoints
+    share it.
+    """
+    slugs = sorted({e['org'] for e in endpoints})
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        org_ids = dict(zip(slugs, executor.map(api.get_org_id_from_slug, slugs)))
+        owners = sorted({i for i in org_ids.values() if i})
+        sources = dict(zip(owners, executor.map(api.get_org_harvesters, owners)))
+    return org_ids, sources
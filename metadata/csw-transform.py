@@ -0,0 +1,168 @@
+import argparse
+import json
+import re
+import sys
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from copy import deepcopy
+from io import BytesIO
+from pathlib import Path
+
+import requests
+from lxml import etree
+
+from transform import ENGINES, compile_stylesheet
+
+NAMESPACES = {
+  'csw': 'http://www.opengis.net/cat/csw/2.0.2',
+  'gmd': 'http://www.isotc211.org/2005/gmd',
+  'gco': 'http://www.isotc211.org/2005/gco',
+  'ows': 'http://www.opengis.net/ows',
+}
+RECORD_TAG = f"{{{NAMESPACES['gmd']}}}MD_Metadata"
+
+
+def get_records(session, endpoint, start, page_size):
+  """Raw GetRecords response for the records [start, start + page_size)"""
+  params = {
+    'service': 'CSW',
+    'version': '2.0.2',
+    'request': 'GetRecords',
+    'typeNames': 'gmd:MD_Metadata',
+    'namespace': f"xmlns(gmd={NAMESPACES['gmd']})",
+    'resultType': 'results',
+    'elementSetName': 'full',
+    'outputSchema': NAMESPACES['gmd'],
+    'startPosition': start,
+    'maxRecords': page_size,
+  }
+  r = session.get(endpoint, params=params, timeout=120)
+  r.raise_for_status()
+  return r.content
+
+
+def search_results(page):
+  """numberOfRecordsMatched and nextRecord (0 after the last record, None if absent) of a page"""
+  for _, elem in etree.iterparse(BytesIO(page), events=('start',)):
+    if elem.tag == f"{{{NAMESPACES['csw']}}}SearchResults":
+      next_record = elem.get('nextRecord')
+      return int(elem.get('numberOfRecordsMatched')), int(next_record) if next_record else None
+    if elem.tag == f"{{{NAMESPACES['ows']}}}ExceptionText":
+      break
+  raise ValueError(f"Not a GetRecords response: {page[:500]!r}")
+
+
+def iter_pages(endpoint, page_size, prefetch, max_records=None):
+  """
+  Yield GetRecords pages in order, fetching up to `prefetch` pages ahead
+
+  Pages are requested up to numberOfRecordsMatched, and no further once a page
+  has a nextRecord of 0, as some catalogs overestimate their number of records.
+  At most `prefetch` + 1 raw pages are held in memory, whatever the catalog size.
+  """
+  session = requests.Session()
+  first = get_records(session, endpoint, 1, page_size)
+  total, next_record = search_results(first)
+  if max_records is not None:
+    total = min(total, max_records)
+  print(f"{total} records to fetch from {endpoint}", file=sys.stderr)
+  yield first
+  if next_record == 0:
+    return
+
+  starts = iter(range(1 + page_size, total + 1, page_size))
+  with ThreadPoolExecutor(max_workers=prefetch) as executor:
+    pending = deque()
+    for start in starts:
+      pending.append(executor.submit(get_records, session, endpoint, start, page_size))
+      if len(pending) >= prefetch:
+        break
+    while pending:
+      page = pending.popleft().result()
+      if search_results(page)[1] == 0:
+        for future in pending:
+          future.cancel()
+        yield page
+        return
+      if (start := next(starts, None)) is not None:
+        pending.append(executor.submit(get_records, session, endpoint, start, page_size))
+      yield page
+
+
+def iter_page_records(page):
+  """Parse a page incrementally, yielding each record and then freeing it"""
+  for _, elem in etree.iterparse(BytesIO(page), events=('end',), tag=RECORD_TAG):
+    yield elem
+    elem.clear()
+    while elem.getprevious() is not None:
+      del elem.getparent()[0]
+
+
+def record_bytes(elem):
+  """Standalone record, without the namespaces only used by the response envelope"""
+  record = deepcopy(elem)
+  envelope = (NAMESPACES['csw'], NAMESPACES['ows'])
+  keep = [prefix for prefix, uri in record.nsmap.items() if uri not in envelope]
+  etree.cleanup_namespaces(record, keep_ns_prefixes=keep)
+  return etree.tostring(record)
+
+
+def record_id(elem):
+  return elem.findtext('gmd:fileIdentifier/gco:CharacterString', namespaces=NAMESPACES)
+
+
+def harvest(endpoint, transformer, page_size=50, prefetch=4, max_records=None):
+  """Yield (id, output, error) for each record of the catalog, output being None on error"""
+  count = 0
+  for page in iter_pages(endpoint, page_size, prefetch, max_records):
+    for elem in iter_page_records(page):
+      if max_records is not None and count >= max_records:
+        return
+      count += 1
+      ident = record_id(elem) or f"record-{count}"
+      try:
+        yield ident, transformer.transform_bytes(record_bytes(elem)), None
+      except Exception as e:
+        yield ident, None, f"{type(e).__name__}: {e}"
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='fetch the records of a CSW catalog and transform them')
+  parser.add_argument('endpoint', help='CSW endpoint url')
+  parser.add_argument('xsl_file')
+  parser.add_argument('-p', '--proc', choices=list(ENGINES), default='saxon')
+  output = parser.add_mutually_exclusive_group()
+  output.add_argument('-o', '--output', type=argparse.FileType('w'), default=sys.stdout,
+                      help='NDJSON output file, one {"id", "output"|"error"} line per record '
+                           '(default: stdout)')
+  output.add_argument('-d', '--output-dir', help='write each transformed record to its own file instead')
+  parser.add_argument('--page-size', type=int, default=50,
+                      help='records per GetRecords request (default: 50)')
+  parser.add_argument('--prefetch', type=int, default=4, help='pages fetched ahead (default: 4)')
+  parser.add_argument('--max-records', type=int, help='stop after this many records')
+  args = parser.parse_args()
+
+  transformer = compile_stylesheet(args.proc, args.xsl_file)
+  output_dir = Path(args.output_dir) if args.output_dir else None
+  if output_dir:
+    output_dir.mkdir(parents=True, exist_ok=True)
+
+  start_time = time.perf_counter()
+  count, failed = 0, 0
+  for ident, result, error in harvest(args.endpoint, transformer, args.page_size, args.prefetch,
+                                      args.max_records):
+    count += 1
+    if result is None:
+      failed += 1
+    if output_dir:
+      if result is None:
+        print(f"{ident}: {error}", file=sys.stderr)
+      else:
+        (output_dir / (re.sub(r'[^\w.-]', '_', ident) + '.xml')).write_text(result)
+    else:
+      line = {'id': ident, 'output': result} if result is not None else {'id': ident, 'error': error}
+      args.output.write(json.dumps(line, ensure_ascii=False) + '\n')
+
+  elapsed = time.perf_counter() - start_time
+  print(f"Transformed {count - failed}/{count} records in {elapsed:.1f}s", file=sys.stderr)
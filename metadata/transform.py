@@ -0,0 +1,140 @@
+"""
+Compiled XSL stylesheets, for lxml (XSLT 1.0) or saxon (XSLT 3.0)
+
+A transformer compiles its stylesheet once and can then be applied to any number
+of records.
+"""
+import glob
+import traceback
+from dataclasses import dataclass, field
+from pathlib import Path
+
+from lxml import etree
+
+
+class LxmlTransformer:
+
+  def __init__(self, xsl_file):
+    self.xslt = etree.XSLT(etree.parse(str(xsl_file)))
+
+  def transform_tree(self, tree):
+    result = self.xslt(tree, CoupledResourceLookUp="'disabled'")
+    return etree.tostring(result, pretty_print=True, encoding='unicode')
+
+  def transform_file(self, xml_file):
+    return self.transform_tree(etree.parse(str(xml_file)))
+
+  def transform_bytes(self, xml):
+    return self.transform_tree(etree.fromstring(xml).getroottree())
+
+  @property
+  def messages(self):
+    return [f"{error.message} (line {error.line})" for error in self.xslt.error_log]
+
+
+class SaxonTransformer:
+
+  def __init__(self, xsl_file):
+    # imported here, so that lxml only runs don't load saxon
+    from saxonche import PySaxonProcessor
+    self.proc = PySaxonProcessor(license=False)
+    self.xslt = self.proc.new_xslt30_processor().compile_stylesheet(stylesheet_file=str(xsl_file))
+    self.xslt.set_property('!indent', 'yes')
+
+  def transform_file(self, xml_file):
+    return self.xslt.transform_to_string(source_file=str(xml_file))
+
+  def transform_bytes(self, xml):
+    node = self.proc.parse_xml(xml_text=xml.decode())
+    return self.xslt.transform_to_string(xdm_node=node)
+
+  @property
+  def messages(self):
+    return []
+
+
+ENGINES = {
+  'lxml': LxmlTransformer,
+  'saxon': SaxonTransformer,
+}
+
+
+def compile_stylesheet(proc, xsl_file):
+  if proc not in ENGINES:
+    raise ValueError(f"Unknown processor: {proc}")
+  return ENGINES[proc](xsl_file)
+
+
+# whitespace-only text between elements is indentation
+_canonical_parser = etree.XMLParser(remove_blank_text=True)
+
+
+def canonicalize(xml):
+  """
+  Canonical form of an XML document: exclusive C14N, indentation removed
+
+  Uses the libxml2 C14N 1.0 serializer, about ten times faster than lxml's C14N 2.0 one.
+  """
+  if isinstance(xml, str):
+    xml = xml.encode()
+  return etree.tostring(etree.fromstring(xml, _canonical_parser), method='c14n', exclusive=True)
+
+
+def iter_records(spec):
+  """XML files of a directory, or matching a glob pattern"""
+  path = Path(spec)
+  if path.is_dir():
+    return sorted(path.glob('*.xml'))
+  return sorted(Path(p) for p in glob.glob(spec, recursive=True))
+
+
+def records_root(spec):
+  """Directory of the records of `iter_records`: the directory, or the fixed part of the pattern"""
+  path = Path(spec)
+  if path.is_dir():
+    return path
+  fixed = []
+  for part in path.parts:
+    if glob.has_magic(part):
+      break
+    fixed.append(part)
+  return Path(*fixed) if fixed else Path()
+
+
+@dataclass
+class RecordResult:
+  path: str
+  error: str | None = None
+  messages: list[str] = field(default_factory=list)
+
+
+# one compiled stylesheet per worker process, see `init_worker`
+_transformer = None
+_output_dir = None
+_records_root = None
+
+
+def init_worker(proc, xsl_file, output_dir, root):
+  global _transformer, _output_dir, _records_root
+  _transformer = compile_stylesheet(proc, xsl_file)
+  _output_dir = Path(output_dir)
+  _records_root = Path(root)
+
+
+def transform_record(path):
+  """
+  Transform a record with the worker stylesheet and write the output, capturing errors
+
+  The output keeps the path of the record relative to the records root, so that
+  records of different directories with the same name don't overwrite each other.
+  """
+  result = RecordResult(str(path))
+  try:
+    output = _transformer.transform_file(path)
+    output_path = _output_dir / Path(path).relative_to(_records_root)
+    output_path.parent.mkdir(parents=True, exist_ok=True)
+    output_path.write_text(output)
+  except Exception as e:
+    result.error = f"{type(e).__name__}: {e}" if str(e) else traceback.format_exc(limit=1)
+  result.messages = _transformer.messages
+  return result
@@ -0,0 +1,122 @@
+import argparse
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field
+from pathlib import Path
+
+from lxml import etree
+
+from transform import canonicalize
+
+
+@dataclass
+class RecordDiff:
+  name: str
+  error: str | None = None
+  differences: list[str] = field(default_factory=list)
+
+
+def node_name(elem):
+  name = etree.QName(elem).localname
+  return f"{elem.prefix}:{name}" if elem.prefix else name
+
+
+def short(text, limit=60):
+  text = (text or '').strip()
+  return repr(text if len(text) <= limit else text[:limit] + '…')
+
+
+def diff_elements(expected, actual, path, differences):
+  """Differing XPaths between two canonical elements, children matched by name and position"""
+  if expected.attrib != actual.attrib:
+    for key in sorted(set(expected.attrib) | set(actual.attrib)):
+      if expected.get(key) != actual.get(key):
+        differences.append(f"attr    {path}/@{key}: {short(expected.get(key))} != {short(actual.get(key))}")
+  if (expected.text or '') != (actual.text or ''):
+    differences.append(f"text    {path}: {short(expected.text)} != {short(actual.text)}")
+
+  def indexed(elem):
+    counts, children = {}, {}
+    for child in elem.iterchildren(etree.Element):
+      name = node_name(child)
+      counts[name] = counts.get(name, 0) + 1
+      children[f"{name}[{counts[name]}]"] = child
+    return children
+
+  expected_children, actual_children = indexed(expected), indexed(actual)
+  for step, child in expected_children.items():
+    if step not in actual_children:
+      differences.append(f"missing {path}/{step}")
+    else:
+      diff_elements(child, actual_children[step], f"{path}/{step}", differences)
+  for step in actual_children:
+    if step not in expected_children:
+      differences.append(f"extra   {path}/{step}")
+
+
+def compare(pair):
+  """Compare a pair of records, skipping the structural diff when the canonical forms are identical"""
+  expected_path, actual_path = pair
+  result = RecordDiff(expected_path.name)
+  if not actual_path.exists():
+    result.error = f"missing {actual_path}"
+    return result
+  expected, actual = expected_path.read_bytes(), actual_path.read_bytes()
+  if expected == actual:
+    return result
+  try:
+    expected, actual = canonicalize(expected), canonicalize(actual)
+  except etree.XMLSyntaxError as e:
+    result.error = f"XMLSyntaxError: {e}"
+    return result
+  if expected == actual:
+    return result
+  expected, actual = etree.fromstring(expected), etree.fromstring(actual)
+  diff_elements(expected, actual, f"/{node_name(expected)}", result.differences)
+  if not result.differences:
+    # same elements, attributes and text: namespace declarations or mixed content differ
+    result.differences.append(f"other   /{node_name(expected)}: namespaces or mixed content")
+  return result
+
+
+def iter_pairs(expected, actual):
+  expected, actual = Path(expected), Path(actual)
+  if expected.is_dir():
+    return [(path, actual / path.name) for path in sorted(expected.glob('*.xml'))]
+  return [(expected, actual)]
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='compare transformed records with the expected ones, '
+                                               'ignoring formatting (canonical XML)')
+  parser.add_argument('expected', help='expected record, or directory of expected records')
+  parser.add_argument('actual', help='actual record, or directory of records with the same file names')
+  parser.add_argument('-w', '--workers', type=int, default=None,
+                      help='number of worker processes (default: number of CPUs)')
+  parser.add_argument('--max-paths', type=int, default=10,
+                      help='differing paths printed per record (default: 10)')
+  args = parser.parse_args()
+
+  pairs = iter_pairs(args.expected, args.actual)
+  start = time.perf_counter()
+  identical, differing, failed = 0, 0, 0
+  with ProcessPoolExecutor(max_workers=args.workers) as executor:
+    for result in executor.map(compare, pairs, chunksize=64):
+      if result.error:
+        failed += 1
+        print(f"{result.name}: {result.error}")
+      elif result.differences:
+        differing += 1
+        print(f"{result.name}: {len(result.differences)} differences")
+        for difference in result.differences[:args.max_paths]:
+          print(f"  {difference}")
+        if len(result.differences) > args.max_paths:
+          print(f"  … {len(result.differences) - args.max_paths} more")
+      else:
+        identical += 1
+  elapsed = time.perf_counter() - start
+
+  print(f"{identical}/{len(pairs)} identical, {differing} different, {failed} missing or invalid "
+        f"in {elapsed:.1f}s")
+  sys.exit(1 if differing or failed else 0)
@@ -1,30 +1,63 @@
+import argparse
+import json
 import sys
-from lxml import etree
-from saxonche import PySaxonProcessor
+import time
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import asdict
+from pathlib import Path
 
-proc = sys.argv[1]
-xsl_file = sys.argv[2]
-xml_file = sys.argv[3]
+from transform import compile_stylesheet, init_worker, iter_records, records_root, transform_record
 
-if proc == 'lxml':
-  xsl = etree.parse(xsl_file)
-  transform = etree.XSLT(xsl)
 
-  iso = etree.parse(xml_file)
-  dcat = transform(iso, CoupledResourceLookUp="'disabled'")
-  print(etree.tostring(dcat, pretty_print=True, encoding='unicode'))
-  for error in transform.error_log:
-    print(f"{error.message} (line {error.line})", file=sys.stderr)
+def batch(argv):
+  parser = argparse.ArgumentParser(prog='xsl-apply.py batch',
+                                   description='apply a stylesheet to many records')
+  parser.add_argument('proc', choices=['lxml', 'saxon'])
+  parser.add_argument('xsl_file')
+  parser.add_argument('records', help='directory of XML records, or glob pattern (quoted)')
+  parser.add_argument('output_dir')
+  parser.add_argument('-w', '--workers', type=int, default=None,
+                      help='number of worker processes (default: number of CPUs)')
+  args = parser.parse_args(argv)
 
-elif proc == 'saxon':
-  with PySaxonProcessor(license=False) as saxon_proc:
-    xslt_proc = saxon_proc.new_xslt30_processor()
+  records = iter_records(args.records)
+  output_dir = Path(args.output_dir)
+  output_dir.mkdir(parents=True, exist_ok=True)
 
-  xslt = xslt_proc.compile_stylesheet(stylesheet_file=xsl_file)
-  xslt.set_property('!indent', 'yes')
+  start = time.perf_counter()
+  failed = []
+  initargs = (args.proc, args.xsl_file, output_dir, records_root(args.records))
+  with ProcessPoolExecutor(max_workers=args.workers, initializer=init_worker,
+                           initargs=initargs) as executor:
+    for result in executor.map(transform_record, records, chunksize=16):
+      if result.error:
+        failed.append(result)
+        print(f"{result.path}: {result.error}", file=sys.stderr)
+  elapsed = time.perf_counter() - start
 
-  output = xslt.transform_to_string(source_file=xml_file)
-  print(output)
+  if failed:
+    with open(output_dir / 'errors.json', 'w') as f:
+      json.dump([asdict(r) for r in failed], f, indent=2, ensure_ascii=False)
+  print(f"Transformed {len(records) - len(failed)}/{len(records)} records in {elapsed:.1f}s "
+        f"({len(records) / elapsed:.0f} records/s) -> {output_dir}")
+  if failed:
+    print(f"{len(failed)} failed, see {output_dir / 'errors.json'}")
 
-else:
-  print("Unknown processor:", proc)
+
+def single(proc, xsl_file, xml_file):
+  try:
+    transformer = compile_stylesheet(proc, xsl_file)
+  except ValueError:
+    print("Unknown processor:", proc)
+    return
+
+  print(transformer.transform_file(xml_file))
+  for message in transformer.messages:
+    print(message, file=sys.stderr)
+
+
+if __name__ == '__main__':
+  if len(sys.argv) > 1 and sys.argv[1] == 'batch':
+    batch(sys.argv[2:])
+  else:
+    single(*sys.argv[1:4])
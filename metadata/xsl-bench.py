@@ -0,0 +1,91 @@
+import argparse
+import hashlib
+import multiprocessing
+import resource
+import statistics
+import sys
+import time
+from pathlib import Path
+
+from transform import ENGINES, canonicalize, compile_stylesheet, iter_records
+
+TESTS_DIR = Path(__file__).parent / 'tests'
+
+
+def benchmark_engine(proc, xsl_file, records):
+  """
+  Run in a fresh process, so that peak RSS doesn't include the other engine
+
+  lxml is loaded by every run, to canonicalize outputs, saxon only by saxon runs.
+  """
+  start = time.perf_counter()
+  transformer = compile_stylesheet(proc, xsl_file)
+  compile_time = time.perf_counter() - start
+
+  latencies, digests, errors = [], [], 0
+  for record in records:
+    start = time.perf_counter()
+    try:
+      output = transformer.transform_bytes(record)
+    except Exception:
+      errors += 1
+      digests.append(None)
+      continue
+    # failed transforms are left out of the timings, hashing the canonical output too
+    latencies.append(time.perf_counter() - start)
+    digests.append(hashlib.sha256(canonicalize(output)).hexdigest())
+
+  return {
+    'compile': compile_time,
+    'p50': statistics.median(latencies) if latencies else None,
+    'p95': (statistics.quantiles(latencies, n=20)[-1] if len(latencies) > 1 else latencies[0]) if latencies else None,
+    'throughput': len(latencies) / sum(latencies) if latencies else None,
+    'rss': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,  # KiB on Linux
+    'errors': errors,
+    'digests': digests,
+  }
+
+
+def column(value, width, format_spec, scale=1):
+  """Right-aligned value of the results table, n/a when an engine failed every record"""
+  return f"{'n/a':>{width}}" if value is None else f"{value * scale:{width}{format_spec}}"
+
+
+def run_isolated(proc, xsl_file, records):
+  ctx = multiprocessing.get_context('spawn')
+  with ctx.Pool(1) as pool:
+    return pool.apply(benchmark_engine, (proc, xsl_file, records))
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='compare lxml and saxon on metadata stylesheets')
+  parser.add_argument('stylesheets', nargs='*', default=sorted(str(p) for p in TESTS_DIR.glob('*.xsl')),
+                      help='stylesheets to benchmark (default: metadata/tests/*.xsl)')
+  parser.add_argument('-c', '--corpus', default=str(TESTS_DIR / '*.xml'),
+                      help='directory of XML records, or glob pattern (default: metadata/tests/*.xml)')
+  parser.add_argument('-s', '--scale', type=int, default=100,
+                      help='number of times the corpus is replicated (default: 100)')
+  parser.add_argument('-e', '--engines', nargs='+', choices=list(ENGINES), default=list(ENGINES))
+  args = parser.parse_args()
+
+  corpus = [p.read_bytes() for p in iter_records(args.corpus)]
+  if not corpus:
+    sys.exit(f"No records found for {args.corpus}")
+  records = corpus * args.scale
+  print(f"Corpus: {len(corpus)} records x {args.scale} = {len(records)} records\n")
+
+  print(f"{'stylesheet':<36} {'engine':<6} {'compile ms':>10} {'p50 ms':>8} {'p95 ms':>8} "
+        f"{'rec/s':>8} {'RSS MiB':>8} {'errors':>7}")
+  for xsl_file in args.stylesheets:
+    results = {}
+    for proc in args.engines:
+      r = results[proc] = run_isolated(proc, xsl_file, records)
+      print(f"{Path(xsl_file).name:<36} {proc:<6} {r['compile'] * 1000:10.1f} {column(r['p50'], 8, '.2f', 1000)} "
+            f"{column(r['p95'], 8, '.2f', 1000)} {column(r['throughput'], 8, '.0f')} {r['rss']:8.0f} {r['errors']:7}")
+
+    if len(results) == 2:
+      (a, ra), (b, rb) = results.items()
+      both = [(x, y) for x, y in zip(ra['digests'], rb['digests']) if x and y]
+      same = sum(x == y for x, y in both)
+      print(f"{'':<36} {a} vs {b}: {same}/{len(both)} identical outputs "
+            f"({len(records) - len(both)} records failed on either engine)")
@@ -0,0 +1,78 @@
+import importlib.util
+import sys
+import threading
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+import pytest
+
+ROOT = Path(__file__).parent.parent
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    """Keep-alive handler answering from the `routes` of its server: path -> callable(handler)"""
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def setup(self):
+        super().setup()
+        with self.server.lock:
+            self.server.connections += 1
+
+    def reply(self, status: int, body: bytes = b"", content_type: str = "application/json",
+              headers: dict | None = None):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        self.dispatch(self.path.split("?")[0])
+
+    def do_PUT(self):
+        self.dispatch(f"PUT {self.path.split('?')[0]}")
+
+    def dispatch(self, key: str):
+        """Route GET requests by path, other methods by `METHOD path`"""
+        if length := int(self.headers.get("Content-Length") or 0):
+            self.body = self.rfile.read(length)
+        with self.server.lock:
+            self.server.hits[key] = self.server.hits.get(key, 0) + 1
+        if route := self.server.routes.get(key):
+            route(self)
+        else:
+            self.reply(404, b"{}")
+
+
+@pytest.fixture
+def stand_in_server():
+    """Local HTTP server counting connections and hits per path, routes are set by the test"""
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StandInHandler)
+    server.daemon_threads = True
+    server.lock = threading.Lock()
+    server.connections = 0
+    server.hits = {}
+    server.routes = {}
+    server.url = f"http://127.0.0.1:{server.server_port}"
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def load_script(path: Path):
+    """Import a script of the repo, e.g. `metadata/csw-transform.py`, with its directory on the path"""
+    path = ROOT / path
+    sys.path.insert(0, str(path.parent))
+    spec = importlib.util.spec_from_file_location(path.stem.replace("-", "_"), path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
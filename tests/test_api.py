@@ -0,0 +1,37 @@
+import pytest
+import requests
+
+from ecospheres.api import DatagouvfrAPI
+
+
+def api(server, **kwargs) -> DatagouvfrAPI:
+    return DatagouvfrAPI(server.url, authenticated=False, backoff_factor=0, **kwargs)
+
+
+def test_connections_are_reused(stand_in_server):
+    stand_in_server.routes["/api/1/site/"] = lambda h: h.reply(200, b'{"id": "site"}')
+    client = api(stand_in_server)
+    for _ in range(20):
+        assert client.get("/api/1/site/") == {"id": "site"}
+    assert stand_in_server.hits["/api/1/site/"] == 20
+    assert stand_in_server.connections == 1
+
+
+@pytest.mark.parametrize("status", [429, 503])
+def test_retries_on_throttling_and_server_errors(stand_in_server, status):
+    def flaky(handler):
+        if stand_in_server.hits["/flaky"] <= 2:
+            handler.reply(status, b"{}")
+        else:
+            handler.reply(200, b'{"ok": true}')
+
+    stand_in_server.routes["/flaky"] = flaky
+    assert api(stand_in_server).get("/flaky") == {"ok": True}
+    assert stand_in_server.hits["/flaky"] == 3
+
+
+def test_last_response_is_raised_once_retries_are_exhausted(stand_in_server):
+    stand_in_server.routes["/down"] = lambda h: h.reply(503, b"{}")
+    with pytest.raises(requests.HTTPError):
+        api(stand_in_server, retries=2).get("/down")
+    assert stand_in_server.hits["/down"] == 3
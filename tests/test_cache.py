@@ -0,0 +1,63 @@
+import json
+
+import requests
+
+from ecospheres.api import DatagouvfrAPI
+from ecospheres.cache import ResponseCache
+
+
+def topic_routes(server):
+    """A topic, readable by id and slug and listed, whose name is changed by PUT"""
+    topic = {"id": "t1", "slug": "mobilite", "name": "before"}
+
+    def read(handler):
+        handler.reply(200, json.dumps(topic).encode())
+
+    def listing(handler):
+        page = {"data": [topic], "next_page": None, "page": 1, "page_size": 20, "total": 1}
+        handler.reply(200, json.dumps(page).encode())
+
+    def update(handler):
+        topic.update(json.loads(handler.body))
+        read(handler)
+
+    server.routes.update({
+        "/api/2/topics/t1/": read,
+        "/api/2/topics/mobilite": read,
+        "/api/2/topics": listing,
+        "PUT /api/2/topics/t1/": update,
+    })
+
+
+def test_reads_are_served_from_the_cache(stand_in_server, tmp_path):
+    topic_routes(stand_in_server)
+    with DatagouvfrAPI(stand_in_server.url, authenticated=False, cache=ResponseCache(tmp_path)) as api:
+        for _ in range(3):
+            assert api.get_topic("mobilite")["name"] == "before"
+    assert stand_in_server.hits["/api/2/topics/mobilite"] == 1
+
+
+def test_write_invalidates_the_object_by_id_and_slug_and_its_listing(stand_in_server, tmp_path,
+                                                                       monkeypatch):
+    monkeypatch.setenv("DATAGOUVFR_API_KEY", "key")
+    topic_routes(stand_in_server)
+    with DatagouvfrAPI(stand_in_server.url, cache=ResponseCache(tmp_path)) as api:
+        assert api.get("/api/2/topics/t1/")["name"] == "before"
+        assert api.get_topic("mobilite")["name"] == "before"
+        assert [t["name"] for t in api.iter_topics("ecospheres")] == ["before"]
+
+        api.put("/api/2/topics/t1/", json={"name": "after"})
+
+        assert api.get("/api/2/topics/t1/")["name"] == "after"
+        assert api.get_topic("mobilite")["name"] == "after"
+        assert [t["name"] for t in api.iter_topics("ecospheres")] == ["after"]
+
+
+def test_zero_ttl_revalidates_reads_cached_by_a_previous_run(stand_in_server, tmp_path):
+    topic_routes(stand_in_server)
+    with DatagouvfrAPI(stand_in_server.url, authenticated=False, cache=ResponseCache(tmp_path)) as api:
+        assert api.get_topic("mobilite")["name"] == "before"
+    # edited meanwhile, outside of the cached API
+    requests.put(f"{stand_in_server.url}/api/2/topics/t1/", json={"name": "edited"}).raise_for_status()
+    with DatagouvfrAPI(stand_in_server.url, authenticated=False, cache=ResponseCache(tmp_path, ttl=0)) as api:
+        assert api.get_topic("mobilite")["name"] == "edited"
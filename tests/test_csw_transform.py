@@ -0,0 +1,65 @@
+from urllib.parse import parse_qsl, urlsplit
+
+from lxml import etree
+
+from conftest import ROOT, load_script
+
+csw_transform = load_script("metadata/csw-transform.py")
+transform = load_script("metadata/transform.py")
+
+FIXTURES = ROOT / "metadata" / "tests"
+RECORD = etree.parse(str(FIXTURES / "89d278a5-ef6a-45a9-9ced-2b348a9963bb.xml")).getroot()
+EXPECTED = etree.parse(str(FIXTURES / "89d278a5-ef6a-45a9-9ced-2b348a9963bb-anchor.xml")).getroot()
+IDENTIFIER = "{http://www.isotc211.org/2005/gmd}fileIdentifier/{http://www.isotc211.org/2005/gco}CharacterString"
+
+
+def record(ident: str, source=RECORD) -> str:
+    copy = etree.fromstring(etree.tostring(source))
+    copy.find(IDENTIFIER).text = ident
+    return etree.tostring(copy, encoding="unicode")
+
+
+def catalog(server, records: list[str], matched: int):
+    """GetRecords route serving `records`, announcing `matched` records as some catalogs do"""
+    server.starts = []
+
+    def get_records(handler):
+        query = dict(parse_qsl(urlsplit(handler.path).query))
+        start, size = int(query["startPosition"]), int(query["maxRecords"])
+        server.starts.append(start)
+        page = records[start - 1:start - 1 + size]
+        next_record = start + len(page) if start - 1 + len(page) < len(records) else 0
+        body = (
+            f'<csw:GetRecordsResponse xmlns:csw="http://www.opengis.net/cat/csw/2.0.2">'
+            f'<csw:SearchResults numberOfRecordsMatched="{matched}" '
+            f'numberOfRecordsReturned="{len(page)}" nextRecord="{next_record}">'
+            f'{"".join(page)}</csw:SearchResults></csw:GetRecordsResponse>'
+        )
+        handler.reply(200, body.encode(), content_type="application/xml")
+
+    server.routes["/csw"] = get_records
+
+
+def test_harvest_transforms_every_record_of_every_page(stand_in_server):
+    catalog(stand_in_server, [record(f"rec-{i}") for i in range(1, 4)], matched=3)
+    transformer = transform.compile_stylesheet("saxon", FIXTURES / "ecospheres-license-anchor.xsl")
+
+    results = list(csw_transform.harvest(f"{stand_in_server.url}/csw", transformer, page_size=2))
+
+    assert [ident for ident, _, _ in results] == ["rec-1", "rec-2", "rec-3"]
+    assert [error for _, _, error in results] == [None] * 3
+    for ident, output, _ in results:
+        expected = record(ident, EXPECTED).encode()
+        assert transform.canonicalize(output.encode()) == transform.canonicalize(expected)
+    assert stand_in_server.starts == [1, 3]
+
+
+def test_pagination_stops_at_next_record_zero(stand_in_server):
+    # 5 records announced, but the second page is the last one
+    catalog(stand_in_server, [record(f"rec-{i}") for i in range(1, 4)], matched=5)
+
+    pages = list(csw_transform.iter_pages(f"{stand_in_server.url}/csw", page_size=2, prefetch=1))
+
+    assert len(pages) == 2
+    assert stand_in_server.starts == [1, 3]
+    assert sum(1 for page in pages for _ in csw_transform.iter_page_records(page)) == 3
@@ -0,0 +1,46 @@
+from dataclasses import dataclass
+from datetime import datetime, timezone
+
+import pytest
+
+from ecospheres.tables import open_table
+
+pyarrow = pytest.importorskip("pyarrow")
+parquet = pytest.importorskip("pyarrow.parquet")
+
+
+@dataclass(slots=True)
+class Row:
+    id: str
+    index: int
+    last_modified: datetime | None
+    score: float | None
+    available: bool | None
+
+
+ROWS = [
+    Row("a", 1, datetime(2025, 1, 2, 3, 4, 5, tzinfo=timezone.utc), 0.0, False),
+    Row("b", 2, None, 0.75, None),
+]
+
+
+def test_parquet_round_trip(tmp_path, monkeypatch):
+    monkeypatch.setattr("ecospheres.tables.BATCH_SIZE", 1)
+    with open_table(tmp_path / "rows", Row, "parquet") as table:
+        table.write(ROWS)
+        table.write(ROWS)
+
+    read = parquet.read_table(tmp_path / "rows.parquet")
+    assert read.schema.field("last_modified").type == pyarrow.timestamp("us", tz="UTC")
+    assert read.schema.field("score").type == pyarrow.float64()
+    assert read.schema.field("available").type == pyarrow.bool_()
+    assert [Row(**row) for row in read.to_pylist()] == ROWS * 2
+
+
+def test_failed_export_leaves_no_partial_table(tmp_path):
+    with pytest.raises(RuntimeError):
+        with open_table(tmp_path / "rows", Row, "parquet") as table:
+            table.write(ROWS)
+            raise RuntimeError("export failed")
+
+    assert not (tmp_path / "rows.parquet").exists()